@@ -8,13 +8,37 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from flask import Flask, render_template, request, jsonify, send_file, url_for, send_from_directory, redirect
 from datetime import datetime, timedelta
 import yt_dlp
+from yt_dlp.utils import sanitize_filename
 import tempfile
 import threading
 import time
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 import re
 import glob
 import uuid
+import copy
+import shutil
+import json
+import requests
+
+from job_queue import JobQueue, QueueFull
+from singleflight import SingleFlight
+from extraction_cache import ExtractionCache, CachedError
+from persistent_cache import PersistentCache
+from output_cache import OutputCache, link_or_copy
+from progress_events import ProgressBroker
+from state_store import SQLiteState, SharedProgressBroker, SharedJobTracker, SharedBandwidth
+from extraction_pool import ExtractionPool, ExtractionTimeout
+from ydl_pool import YoutubeDLPool
+import ytdlp_cache
+from extraction_profiles import PROFILES, extract_opts, parse_player_clients
+from streaming import FFmpegStream, build_ffmpeg_command
+from delivery import FileDelivery
+from parallel_download import ParallelStreamDownload
+from segmented_download import SegmentedDownload, SegmentError
+from bandwidth import BandwidthManager
+from throttle import ThrottleMonitor, Throttled
+from postprocess import merge_command, audio_command, is_passthrough, run_ffmpeg, StreamingTranscode, PostProcessError
 
 app = Flask(__name__)
 
@@ -45,8 +69,142 @@ def after_request(response):
     return response
 
 # Global variables
-download_progress = {}
-video_cache = {}  # Cache video info to avoid re-extraction
+# gunicorn worker processes on this host; start.sh passes the same value to --workers
+WEB_CONCURRENCY = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+
+# Where progress and queue state live: sqlite is shared by every worker process on
+# the host, memory keeps it inside each process and only works with a single worker
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sqlite')
+if STATE_BACKEND == 'sqlite':
+    shared_state = SQLiteState(os.environ.get('STATE_PATH', os.path.join('cache', 'state.sqlite3')))
+    download_progress = SharedProgressBroker(shared_state)  # Latest progress per download, pushed to /progress/<id>/events
+    job_tracker = SharedJobTracker(shared_state)
+    shared_bandwidth = SharedBandwidth(shared_state)
+elif STATE_BACKEND == 'memory':
+    if WEB_CONCURRENCY > 1:
+        print(f"Warning: STATE_BACKEND=memory with {WEB_CONCURRENCY} workers; progress polls may miss their download")
+    download_progress = ProgressBroker()
+    job_tracker = None
+    shared_bandwidth = None
+else:
+    raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}, expected 'sqlite' or 'memory'")
+
+# How finished files reach clients: accel (nginx X-Accel-Redirect), xsendfile,
+# sendfile (kernel sendfile through gunicorn) or python
+file_delivery = FileDelivery(
+    mode=os.environ.get('DELIVERY_MODE', 'sendfile'),
+    root='downloads',
+    accel_prefix=os.environ.get('DELIVERY_ACCEL_PREFIX', '/protected-downloads/'),
+)
+
+# Server-Sent Events: how long a stream waits for updates and how often it sends keep-alives
+PROGRESS_STREAM_WAIT = 5
+PROGRESS_STREAM_HEARTBEAT = 15
+# Cache video info to avoid re-extraction; bounded, expiring and refreshed in the background
+video_cache = ExtractionCache(
+    max_entries=int(os.environ.get('VIDEO_CACHE_MAX_ENTRIES', '1000')),
+    max_bytes=int(os.environ.get('VIDEO_CACHE_MAX_MB', '128')) * 1024 * 1024,
+    ttl=int(os.environ.get('VIDEO_CACHE_TTL', '3600')),
+    stale_ttl=int(os.environ.get('VIDEO_CACHE_STALE_TTL', '1800')),
+    negative_ttl=int(os.environ.get('VIDEO_CACHE_NEGATIVE_TTL', '120')),
+)
+
+# Second cache tier on disk, shared by all workers and kept across restarts.
+# Set VIDEO_STORE_PATH to an empty string to disable it.
+VIDEO_STORE_PATH = os.environ.get('VIDEO_STORE_PATH', os.path.join('cache', 'extractions.sqlite3'))
+video_store = None
+if VIDEO_STORE_PATH:
+    video_store = PersistentCache(VIDEO_STORE_PATH, ttl=int(os.environ.get('VIDEO_STORE_TTL', '21600')))
+
+# Download scheduling: a fixed pool of workers drains a bounded queue
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '2'))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get('DOWNLOAD_QUEUE_SIZE', '50'))
+
+# ffmpeg merges and audio conversions run on their own pool; by default the cores are
+# split between the gunicorn workers, so the host runs one ffmpeg per core
+POSTPROCESS_WORKERS = int(os.environ.get('POSTPROCESS_WORKERS',
+                                         str(max(1, (os.cpu_count() or 2) // WEB_CONCURRENCY))))
+POSTPROCESS_QUEUE_SIZE = int(os.environ.get('POSTPROCESS_QUEUE_SIZE', '100'))
+# MP3 encoding can start while the audio is still downloading
+PIPELINED_TRANSCODE = os.environ.get('PIPELINED_TRANSCODE', '1') == '1'
+# ffmpeg processes the pool runs at once
+ffmpeg_slots = threading.BoundedSemaphore(POSTPROCESS_WORKERS)
+# Pipelined encodes mostly wait for the network, so they have their own small budget
+# instead of holding a pool slot for the whole transfer
+PIPELINED_TRANSCODE_SLOTS = int(os.environ.get('PIPELINED_TRANSCODE_SLOTS', '2'))
+pipeline_slots = threading.BoundedSemaphore(max(1, PIPELINED_TRANSCODE_SLOTS))
+
+# Per-job transfer settings: fragments fetched at once, and whether the video and
+# audio of merged formats are downloaded side by side
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', '4'))
+PARALLEL_STREAMS = os.environ.get('PARALLEL_STREAMS', '1') == '1'
+# Connections used for single-file formats fetched in byte ranges (1 disables it)
+SEGMENTED_CONNECTIONS = int(os.environ.get('SEGMENTED_CONNECTIONS', '4'))
+SEGMENT_SIZE = int(os.environ.get('SEGMENT_SIZE_MB', '4')) * 1024 * 1024
+
+# Bandwidth shared by all running downloads (Mbit/s, 0 = unlimited), split by job kind weight.
+# With the sqlite state backend the limit covers every gunicorn worker on the host, each
+# using the part that matches the weight of its active downloads.
+BANDWIDTH_LIMIT = float(os.environ.get('BANDWIDTH_LIMIT_MBPS', '0')) * 125000
+JOB_BANDWIDTH_LIMIT = float(os.environ.get('JOB_BANDWIDTH_LIMIT_MBPS', '0')) * 125000
+BANDWIDTH_WEIGHTS = {
+    kind: float(weight)
+    for kind, weight in (item.split('=') for item in os.environ.get('BANDWIDTH_WEIGHTS', 'audio=4,video=1').split(','))
+}
+bandwidth = BandwidthManager(BANDWIDTH_LIMIT, JOB_BANDWIDTH_LIMIT, BANDWIDTH_WEIGHTS, host=shared_bandwidth)
+
+# A download slower than this (KB/s) for a whole window is resumed from a fresh stream URL
+throttle_monitor = ThrottleMonitor(
+    min_speed=int(os.environ.get('THROTTLE_MIN_SPEED_KB', '128')) * 1024,
+    window=float(os.environ.get('THROTTLE_WINDOW', '15')),
+    max_resumes=int(os.environ.get('THROTTLE_MAX_RESUMES', '3')),
+)
+
+# In-flight /extract calls, keyed by video_id
+extract_flight = SingleFlight()
+
+# Warm YoutubeDL instances per option profile for work done in this process (format selection)
+ydl_pool = YoutubeDLPool(max_idle=int(os.environ.get('YDL_POOL_SIZE', '4')))
+
+# yt-dlp's cache of player JS and signature solutions, shared by every worker and
+# extraction process; start.sh warms it before the server starts
+YTDLP_CACHE_DIR = ytdlp_cache.cache_dir(os.environ.get('YTDLP_CACHE_DIR', ytdlp_cache.DEFAULT_ROOT))
+
+# /extract only needs metadata and the adaptive formats: the lite profile asks fewer
+# player clients and skips manifests and translated subtitles; full is yt-dlp's default.
+# Extractions for downloads and streams always use full.
+EXTRACT_PROFILE = os.environ.get('EXTRACT_PROFILE', 'lite')
+if EXTRACT_PROFILE not in PROFILES:
+    raise ValueError(f"Unknown EXTRACT_PROFILE {EXTRACT_PROFILE!r}, expected one of {', '.join(PROFILES)}")
+EXTRACT_PLAYER_CLIENTS = parse_player_clients(os.environ.get('EXTRACT_PLAYER_CLIENTS'))
+
+# yt-dlp extractions run in worker processes so they do not hold the GIL of the request
+# threads; 0 runs them in the request thread. An extraction mostly waits on YouTube,
+# so the host runs several per core
+EXTRACT_PROCESSES = int(os.environ.get('EXTRACT_PROCESSES',
+                                       str(max(2, 4 * (os.cpu_count() or 2) // WEB_CONCURRENCY))))
+extraction_pool = ExtractionPool(
+    workers=EXTRACT_PROCESSES,
+    timeout=float(os.environ.get('EXTRACT_TIMEOUT', '60')),
+    max_tasks=int(os.environ.get('EXTRACT_MAX_TASKS', '100')),
+)
+
+# Finished downloads, keyed by video id and output options, so repeats are served from disk
+output_cache = OutputCache(
+    os.path.join('downloads', 'outputs'),
+    os.path.join('cache', 'outputs.sqlite3'),
+    max_bytes=int(os.environ.get('OUTPUT_CACHE_MAX_GB', '20')) * 1024 ** 3,
+    ttl=int(os.environ.get('OUTPUT_CACHE_TTL', '86400')),
+)
+
+# Raw video-only and audio-only streams, keyed by video id and itag, so merges and
+# audio conversions of the same video share one download of each stream
+component_cache = OutputCache(
+    os.path.join('downloads', 'components'),
+    os.path.join('cache', 'components.sqlite3'),
+    max_bytes=int(os.environ.get('COMPONENT_CACHE_MAX_GB', '10')) * 1024 ** 3,
+    ttl=int(os.environ.get('COMPONENT_CACHE_TTL', '86400')),
+)
 
 # SEO Routes
 @app.route('/robots.txt')
@@ -143,6 +301,53 @@ def extract_video_id(url):
         return match.group(6)
     return None
 
+def find_video_info(video_id):
+    """Return the /extract result for video_id from memory or the shared store, or None"""
+    try:
+        cached_info = video_cache.get(video_id)
+    except CachedError:
+        return None
+    if cached_info or not video_store:
+        return cached_info
+    
+    # /extract may have run in another worker process
+    stored = video_store.get(video_id)
+    if not stored:
+        return None
+    return promote_stored_info(video_id, stored[0])
+
+def promote_stored_info(video_id, cached_info):
+    """Serve an entry from video_store from memory while it is re-extracted.
+    
+    Stored entries lack the info dict downloads reuse, so they go into the
+    memory cache already stale; the first lookup starts a background refresh
+    that restores it.
+    """
+    video_cache.set(video_id, cached_info, ttl=0)
+    return cached_info
+
+def get_cached_info(video_id):
+    """Return the reusable info dict stored by /extract, if any"""
+    try:
+        cached_info = video_cache.get(video_id) if video_id else None
+    except CachedError:
+        return None
+    if not cached_info:
+        return None
+    return cached_info.get('info')
+
+def run_download(ydl, url, info=None):
+    """Download url, feeding a previously extracted info dict back to yt-dlp when we have one"""
+    if info is not None:
+        try:
+            # process_ie_result only does format selection and the download,
+            # skipping the webpage, player and signature requests
+            return ydl.process_ie_result(copy.deepcopy(info), download=True)
+        except yt_dlp.utils.DownloadError as e:
+            # Stream URLs expire; fall back to a fresh extraction
+            print(f"Cached info failed to download, re-extracting {url}: {e}")
+    return ydl.extract_info(url, download=True)
+
 def format_filesize(size):
     """Format file size in human readable format"""
     if not size:
@@ -158,6 +363,214 @@ def format_filesize(size):
 def index():
     return render_template('index.html')
 
+# Audio outputs: format selector, FFmpegExtractAudio codec and quality. MP3 is
+# transcoded; M4A and Opus copy YouTube's AAC (itag 140) or Opus (itag 251) stream
+AUDIO_OUTPUTS = {
+    'mp3': ('bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best', 'mp3', '192'),
+    'm4a': ('140/bestaudio[ext=m4a]', 'm4a', None),
+    'opus': ('251/bestaudio[acodec=opus]', 'opus', None),
+}
+
+# Passthrough entries offered by /extract: output id -> (itag, extension, display name)
+AUDIO_PASSTHROUGH_STREAMS = {
+    'm4a': ('140', 'm4a', 'M4A Audio (original AAC)'),
+    'opus': ('251', 'opus', 'Opus Audio (original)'),
+}
+
+def audio_ydl_opts(output):
+    """yt-dlp options for one of the AUDIO_OUTPUTS"""
+    format_selector, codec, quality = AUDIO_OUTPUTS[output]
+    postprocessor = {
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': codec,
+    }
+    if quality:
+        postprocessor['preferredquality'] = quality
+    return {
+        'format': format_selector,
+        'postprocessors': [postprocessor],
+    }
+
+def build_format_list(info):
+    """Build the height-bucketed format list that /extract returns"""
+    formats = []
+    raw_formats = info.get('formats', [])
+    
+    # Video formats
+    video_qualities = {}
+    for f in raw_formats:
+        if not isinstance(f, dict):
+            continue
+        
+        format_id = f.get('format_id', '')
+        height = f.get('height')
+        vcodec = f.get('vcodec', '')
+        filesize = f.get('filesize') or f.get('filesize_approx', 0)
+        
+        # Skip if no format ID or audio-only
+        if not format_id or vcodec == 'none' or not height:
+            continue
+        
+        # Determine quality label
+        if height >= 2160:
+            quality_label = "4K (2160p)"
+            sort_key = 2160
+        elif height >= 1440:
+            quality_label = "1440p"
+            sort_key = 1440
+        elif height >= 1080:
+            quality_label = "1080p"
+            sort_key = 1080
+        elif height >= 720:
+            quality_label = "720p"
+            sort_key = 720
+        elif height >= 480:
+            quality_label = "480p"
+            sort_key = 480
+        elif height >= 360:
+            quality_label = "360p"
+            sort_key = 360
+        else:
+            continue  # Skip very low quality
+        
+        # Only keep the best format for each quality
+        if quality_label not in video_qualities or sort_key > video_qualities[quality_label]['sort_key']:
+            video_qualities[quality_label] = {
+                'format_id': format_id,
+                'display_name': f"MP4 Video - {quality_label}",
+                'quality': quality_label,
+                'ext': 'mp4',
+                'filesize': filesize,
+                'sort_key': sort_key
+            }
+    
+    # Convert to list and sort by quality
+    formats.extend(video_qualities.values())
+    formats.sort(key=lambda x: x['sort_key'], reverse=True)
+    
+    # Add MP3 audio format
+    formats.append({
+        'format_id': 'mp3',
+        'display_name': 'MP3 Audio',
+        'quality': 'audio',
+        'ext': 'mp3',
+        'filesize': None,
+        'sort_key': 0
+    })
+    
+    # Original audio streams, delivered without re-encoding when the video has them
+    for format_id, (itag, ext, display_name) in AUDIO_PASSTHROUGH_STREAMS.items():
+        stream = next((f for f in raw_formats if isinstance(f, dict) and f.get('format_id') == itag), None)
+        if stream:
+            formats.append({
+                'format_id': format_id,
+                'display_name': display_name,
+                'quality': 'audio',
+                'ext': ext,
+                'filesize': stream.get('filesize') or stream.get('filesize_approx'),
+                'sort_key': 0
+            })
+    
+    return formats
+
+# Extraction errors that will not go away on retry and are worth caching
+UNAVAILABLE_VIDEO_MARKERS = (
+    'private video',
+    'video unavailable',
+    'has been removed',
+    'no longer available',
+    'account associated with this video has been terminated',
+    'incomplete youtube id',
+)
+
+def needs_full_extraction(info):
+    """Whether a lite extraction lacks formats that only the full profile finds"""
+    # Live streams and premieres only have HLS/DASH manifest formats
+    return not info or not info.get('formats') or info.get('live_status') in ('is_live', 'is_upcoming', 'post_live')
+
+def extract_video_info(url):
+    """Extract url for /extract with EXTRACT_PROFILE.
+    
+    A lite extraction that fails or falls short is repeated with the full
+    profile, so videos the restricted player clients cannot serve still work.
+    Runs in an extraction worker process; the info dict comes back reduced.
+    """
+    def profile_opts(profile):
+        return {
+            **extract_opts(profile, EXTRACT_PLAYER_CLIENTS),
+            'ignoreerrors': False,
+            'retries': 3,
+            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+            'cachedir': YTDLP_CACHE_DIR,
+        }
+    
+    if EXTRACT_PROFILE == 'lite':
+        try:
+            info = extraction_pool.extract(profile_opts('lite'), url)
+            if not needs_full_extraction(info):
+                return info
+        except yt_dlp.utils.DownloadError as e:
+            print(f"Lite extraction of {url} failed, retrying with the full profile: {e}")
+    return extraction_pool.extract(profile_opts('full'), url)
+
+def load_video_info(video_id, url, use_store=True):
+    """Run the yt-dlp extraction for /extract and cache the result.
+    
+    use_store=False always extracts, for refreshing a stale entry.
+    """
+    # A concurrent caller may have filled the cache while we waited our turn
+    cached_info = video_cache.peek(video_id)
+    if cached_info:
+        return cached_info
+    
+    # Another worker, or a previous run, may already have extracted it
+    if video_store and use_store:
+        stored = video_store.get(video_id)
+        if stored:
+            return promote_stored_info(video_id, stored[0])
+    
+    try:
+        info = extract_video_info(url)
+    except yt_dlp.utils.DownloadError as e:
+        # Remember private/removed videos briefly so repeat requests fail fast
+        if any(marker in str(e).lower() for marker in UNAVAILABLE_VIDEO_MARKERS):
+            video_cache.set_error(video_id, str(e))
+        raise
+    
+    if not info:
+        return None
+    
+    # Build video info object
+    video_info = {
+        'title': info.get('title', 'Unknown Title'),
+        'uploader': info.get('uploader', 'Unknown'),
+        'duration': info.get('duration', 0),
+        'thumbnail': info.get('thumbnail', ''),
+        'view_count': info.get('view_count', 0),
+        'upload_date': info.get('upload_date', '')
+    }
+    
+    # Cache the result, keeping the info dict so downloads skip re-extraction
+    cached_info = {
+        'video': video_info,
+        'formats': build_format_list(info),
+        'info': info
+    }
+    video_cache.set(video_id, cached_info)
+    
+    # Only what /extract returns goes to disk, never the full info dict
+    if video_store:
+        video_store.set(video_id, {'video': cached_info['video'], 'formats': cached_info['formats']})
+    return cached_info
+
+def refresh_video_info(video_id):
+    """Re-extract a stale cache entry in the background"""
+    url = f"https://www.youtube.com/watch?v={video_id}"
+    # The disk copy outlives the memory entry; only a new extraction refreshes it
+    extract_flight.do(video_id, load_video_info, video_id, url, use_store=False)
+
+video_cache.refresh = refresh_video_info
+
 @app.route('/extract', methods=['POST'])
 def extract_video():
     """Extract video information - matches what the frontend expects"""
@@ -177,164 +590,47 @@ def extract_video():
             return jsonify({'success': False, 'error': 'Invalid YouTube URL'}), 400
         
         # Check cache first
-        if video_id in video_cache:
-            cached_info = video_cache[video_id]
-            return jsonify({
-                'success': True,
-                'video_id': video_id,
-                'video': cached_info['video'],
-                'formats': cached_info['formats']
-            })
+        cached_info = video_cache.get(video_id)
         
-        # Extract video info
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'ignoreerrors': False,
-            'retries': 3,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
-        }
+        if not cached_info:
+            # Concurrent requests for the same video share one extraction
+            cached_info = extract_flight.do(video_id, load_video_info, video_id, url)
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if not info:
-                return jsonify({'success': False, 'error': 'Failed to extract video information'}), 500
-            
-            # Build video info object
-            video_info = {
-                'title': info.get('title', 'Unknown Title'),
-                'uploader': info.get('uploader', 'Unknown'),
-                'duration': info.get('duration', 0),
-                'thumbnail': info.get('thumbnail', ''),
-                'view_count': info.get('view_count', 0),
-                'upload_date': info.get('upload_date', '')
-            }
-            
-            # Process formats
-            formats = []
-            raw_formats = info.get('formats', [])
-            
-            # Video formats
-            video_qualities = {}
-            for f in raw_formats:
-                if not isinstance(f, dict):
-                    continue
-                
-                format_id = f.get('format_id', '')
-                height = f.get('height')
-                vcodec = f.get('vcodec', '')
-                filesize = f.get('filesize') or f.get('filesize_approx', 0)
-                
-                # Skip if no format ID or audio-only
-                if not format_id or vcodec == 'none' or not height:
-                    continue
-                
-                # Determine quality label
-                if height >= 2160:
-                    quality_label = "4K (2160p)"
-                    sort_key = 2160
-                elif height >= 1440:
-                    quality_label = "1440p"
-                    sort_key = 1440
-                elif height >= 1080:
-                    quality_label = "1080p"
-                    sort_key = 1080
-                elif height >= 720:
-                    quality_label = "720p"
-                    sort_key = 720
-                elif height >= 480:
-                    quality_label = "480p"
-                    sort_key = 480
-                elif height >= 360:
-                    quality_label = "360p"
-                    sort_key = 360
-                else:
-                    continue  # Skip very low quality
-                
-                # Only keep the best format for each quality
-                if quality_label not in video_qualities or sort_key > video_qualities[quality_label]['sort_key']:
-                    video_qualities[quality_label] = {
-                        'format_id': format_id,
-                        'display_name': f"MP4 Video - {quality_label}",
-                        'quality': quality_label,
-                        'ext': 'mp4',
-                        'filesize': filesize,
-                        'sort_key': sort_key
-                    }
-            
-            # Convert to list and sort by quality
-            formats.extend(video_qualities.values())
-            formats.sort(key=lambda x: x['sort_key'], reverse=True)
-            
-            # Add MP3 audio format
-            formats.append({
-                'format_id': 'mp3',
-                'display_name': 'MP3 Audio',
-                'quality': 'audio',
-                'ext': 'mp3',
-                'filesize': None,
-                'sort_key': 0
-            })
-            
-            # Cache the result
-            video_cache[video_id] = {
-                'video': video_info,
-                'formats': formats
-            }
-            
-            return jsonify({
-                'success': True,
-                'video_id': video_id,
-                'video': video_info,
-                'formats': formats
-            })
+        if not cached_info:
+            return jsonify({'success': False, 'error': 'Failed to extract video information'}), 500
+        
+        return jsonify({
+            'success': True,
+            'video_id': video_id,
+            'video': cached_info['video'],
+            'formats': cached_info['formats']
+        })
             
+    except ExtractionTimeout as e:
+        return jsonify({'success': False, 'error': f'Server is busy, please try again shortly ({e})'}), 503
     except Exception as e:
         return jsonify({'success': False, 'error': f'Failed to extract video information: {str(e)}'}), 500
 
 @app.route('/download/<video_id>/<format_id>')
 def download_video_file(video_id, format_id):
-    """Download video file - matches what the frontend expects"""
+    """Queue a download of an analyzed video - matches what the frontend expects"""
     
     # Check if we have cached video info
-    if video_id not in video_cache:
+    cached_info = find_video_info(video_id)
+    if not cached_info:
         return jsonify({'error': 'Video information not found. Please analyze the video first.'}), 404
     
-    cached_info = video_cache[video_id]
-    video_info = cached_info['video']
-    
-    # Create downloads directory if it doesn't exist
-    downloads_dir = 'downloads'
-    if not os.path.exists(downloads_dir):
-        os.makedirs(downloads_dir)
-    
-    # Generate unique download filename
-    safe_title = re.sub(r'[<>:"/\\|?*]', '', video_info['title'])
-    safe_title = safe_title.replace(' ', '_')
-    
-    if format_id == 'mp3':
-        filename = f"{safe_title}.mp3"
-        file_path = os.path.join(downloads_dir, filename)
-        
-        # Configure for MP3 download
+    if format_id in AUDIO_OUTPUTS:
+        # Configure for audio download (MP3 transcode or M4A/Opus passthrough)
         ydl_opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
-            'outtmpl': file_path[:-4] + '.%(ext)s',  # Remove .mp3 extension, let yt-dlp handle it
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
+            **audio_ydl_opts(format_id),
             'no_warnings': True,
             'quiet': True,
             'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+            'cachedir': YTDLP_CACHE_DIR,
         }
         
     else:
-        filename = f"{safe_title}.mp4"
-        file_path = os.path.join(downloads_dir, filename)
-        
         # Configure for MP4 download
         quality_lower = format_id.lower()
         
@@ -355,137 +651,147 @@ def download_video_file(video_id, format_id):
         
         ydl_opts = {
             'format': format_selector,
-            'outtmpl': file_path[:-4] + '.%(ext)s',  # Remove .mp4 extension, let yt-dlp handle it
             'merge_output_format': 'mp4',
             'no_warnings': True,
             'quiet': True,
             'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+            'cachedir': YTDLP_CACHE_DIR,
         }
     
+    # Reconstruct original URL from video_id
+    original_url = f"https://www.youtube.com/watch?v={video_id}"
+    
+    # Queue the download instead of running it inside this request
     try:
-        # Reconstruct original URL from video_id
-        original_url = f"https://www.youtube.com/watch?v={video_id}"
-        
-        # Download the file
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([original_url])
-        
-        # Find the actual downloaded file
-        time.sleep(1)  # Wait for download to complete
-        
-        # Look for the downloaded file
-        actual_file = None
-        for file in os.listdir(downloads_dir):
-            if file.startswith(safe_title.split('_')[0]) and file.endswith('.mp3' if format_id == 'mp3' else '.mp4'):
-                actual_file = file
-                break
-        
-        if not actual_file:
-            # Fallback: look for any file with the expected extension
-            expected_ext = '.mp3' if format_id == 'mp3' else '.mp4'
-            for file in os.listdir(downloads_dir):
-                if file.endswith(expected_ext):
-                    # Check if it's a recent file (within last 10 seconds)
-                    file_path = os.path.join(downloads_dir, file)
-                    if os.path.getmtime(file_path) > time.time() - 10:
-                        actual_file = file
-                        break
-        
-        if actual_file:
-            actual_file_path = os.path.join(downloads_dir, actual_file)
-            # Check if it's a stream request (for opening in new tab)
-            stream_mode = request.args.get('stream', 'false').lower() == 'true'
-            
-            if stream_mode:
-                # For streaming mode, don't force download - let browser handle it
-                return send_file(actual_file_path, 
-                               mimetype='video/mp4' if format_id != 'mp3' else 'audio/mpeg',
-                               as_attachment=False)
-            else:
-                # For download mode, force download
-                return send_file(actual_file_path, as_attachment=True, download_name=actual_file)
-        else:
-            return jsonify({'error': 'Download completed but file not found'}), 500
-            
+        download_id, status = start_download_job(original_url, video_id, ydl_opts)
+    except QueueFull:
+        return jsonify({'error': 'Server is busy, please try again in a few minutes'}), 503
     except Exception as e:
         return jsonify({'error': f'Download failed: {str(e)}'}), 500
+    
+    # Check if it's a stream request (for opening in new tab)
+    stream_mode = request.args.get('stream', 'false').lower() == 'true'
+    file_url = url_for('download_file', download_id=download_id, stream='true' if stream_mode else None)
+    
+    # Browsers following a plain link go straight to a file that is already there
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    if status == 'completed' and not wants_json:
+        return redirect(file_url)
+    
+    return jsonify({
+        'download_id': download_id,
+        'status': status,
+        'queue_position': download_queue.position(download_id),
+        'estimated_wait': round(download_queue.estimated_wait(download_id)),
+        'progress_url': url_for('get_progress', download_id=download_id),
+        'events_url': url_for('progress_events', download_id=download_id),
+        'file_url': file_url
+    }), 200 if status == 'completed' else 202
+
+# Heights offered by /stream, keyed by the quality names the frontends use
+STREAM_HEIGHTS = {'4K': 2160, '1440p': 1440, '1080p': 1080, '720p': 720, '480p': 480, '360p': 360}
+STREAM_MAX_CONCURRENT = int(os.environ.get('STREAM_MAX_CONCURRENT', '8'))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONCURRENT)
+
+def select_formats(info, format_selector):
+    """Run yt-dlp's format selection on an info dict and return the chosen formats"""
+    ydl_opts = {
+        'format': format_selector,
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+    }
+    
+    # Only format selection, no new extraction
+    with ydl_pool.checkout(ydl_opts) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    
+    # Merged selections come back as requested_formats, single files as the info itself
+    return selected.get('requested_formats') or [selected]
+
+def extract_reusable_info(url):
+    """Extract a video once and return the info dict in reusable form"""
+    # Stream URLs for a download or /stream: yt-dlp's full extraction, every player client
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'cachedir': YTDLP_CACHE_DIR,
+    }
+    return extraction_pool.extract(ydl_opts, url)
+
+def resolve_stream_sources(video_id, format_selector):
+    """Select formats for a stream and return their direct URLs with HTTP headers"""
+    info = get_cached_info(video_id)
+    if info is None:
+        info = extract_reusable_info(f"https://www.youtube.com/watch?v={video_id}")
+    
+    return [(f['url'], f.get('http_headers') or {}) for f in select_formats(info, format_selector)]
 
 @app.route('/stream/<video_id>/<format_id>')
 def stream_video(video_id, format_id):
     try:
         # Get video info from cache
-        cached_info = video_cache.get(video_id)
+        cached_info = find_video_info(video_id)
         if not cached_info:
             return jsonify({'error': 'Video info not found. Please analyze the video first.'}), 404
         
-        url = cached_info['url']
+        # Map format_id to actual format selector; /extract format ids map through their quality
+        height = STREAM_HEIGHTS.get(format_id)
+        if height is None:
+            for f in cached_info.get('formats', []):
+                if isinstance(f, dict) and f.get('format_id') == format_id and f.get('sort_key'):
+                    height = f['sort_key']
         
-        # Map format_id to actual format selector
-        format_selectors = {
-            '4K': 'best[height<=2160][ext=mp4]/best[height<=2160]/best[ext=mp4]/best',
-            '1440p': 'best[height<=1440][ext=mp4]/best[height<=1440]/best[ext=mp4]/best',
-            '1080p': 'best[height<=1080][ext=mp4]/best[height<=1080]/best[ext=mp4]/best',
-            '720p': 'best[height<=720][ext=mp4]/best[height<=720]/best[ext=mp4]/best',
-            '480p': 'best[height<=480][ext=mp4]/best[height<=480]/best[ext=mp4]/best',
-            '360p': 'best[height<=360][ext=mp4]/best[height<=360]/best[ext=mp4]/best',
-            'mp3': 'bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio'
-        }
-        
-        # Get the format selector for the requested format
-        format_selector = format_selectors.get(format_id)
-        if not format_selector:
+        if format_id.lower() == 'mp3':
+            output_format = 'mp3'
+            format_selector = 'bestaudio[ext=m4a]/bestaudio'
+        elif height:
+            output_format = 'mp4'
+            # Separate H.264 video and AAC audio are muxed on the fly into fragmented MP4
+            format_selector = (f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/'
+                               f'best[height<={height}][ext=mp4]/best[height<={height}]/best')
+        else:
             return jsonify({'error': f'Format {format_id} not supported'}), 400
         
-        # Create downloads directory if it doesn't exist
-        downloads_dir = os.path.join(os.getcwd(), 'downloads')
-        os.makedirs(downloads_dir, exist_ok=True)
+        ffmpeg = shutil.which('ffmpeg')
+        if not ffmpeg:
+            return jsonify({'error': 'Streaming is not available on this server'}), 503
         
-        # Configure yt-dlp options
-        ydl_opts = {
-            'format': format_selector,
-            'outtmpl': os.path.join(downloads_dir, f'{video_id}.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'ignoreerrors': True,
-            'noplaylist': True,
-        }
+        # Each stream holds an ffmpeg process and a request thread for its whole length
+        if not stream_slots.acquire(blocking=False):
+            return jsonify({'error': 'Too many active streams, please try again shortly'}), 503
         
-        # Add audio-specific options for MP3
-        if format_id == 'mp3':
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }]
-        
-        # Download the video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        
-        # Find the downloaded file
-        downloaded_file = None
-        for file in os.listdir(downloads_dir):
-            if file.startswith(video_id):
-                downloaded_file = os.path.join(downloads_dir, file)
-                break
+        try:
+            sources = resolve_stream_sources(video_id, format_selector)
+            stream = FFmpegStream(build_ffmpeg_command(sources, output_format, ffmpeg),
+                                  on_close=stream_slots.release)
+        except Exception:
+            stream_slots.release()
+            raise
         
-        if not downloaded_file or not os.path.exists(downloaded_file):
-            return jsonify({'error': 'Download failed - file not found'}), 500
+        # Wait for the first bytes so failures still get a proper error response
+        stream.start()
         
         # Determine MIME type
-        if format_id == 'mp3':
+        if output_format == 'mp3':
             mimetype = 'audio/mpeg'
         else:
             mimetype = 'video/mp4'
         
-        # Stream the file
-        return send_file(
-            downloaded_file,
-            mimetype=mimetype,
-            as_attachment=False,
-            download_name=f"{cached_info['title']}.{downloaded_file.split('.')[-1]}"
-        )
+        title = (cached_info.get('video') or cached_info).get('title') or video_id
+        safe_title = re.sub(r'[<>:"/\\|?*]', '', title)
         
+        # Send bytes while ffmpeg is still producing them; the length is not known up front
+        response = app.response_class(stream, mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(f'{safe_title}.{output_format}')}"
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Accept-Ranges'] = 'none'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+        
+    except ExtractionTimeout as e:
+        return jsonify({'error': f'Server is busy, please try again shortly ({e})'}), 503
     except Exception as e:
         print(f"Error streaming video: {e}")
         return jsonify({'error': f'Streaming failed: {str(e)}'}), 500
@@ -494,12 +800,33 @@ class ProgressHook:
     def __init__(self, download_id):
         self.download_id = download_id
         self.last_update = time.time()
+        self.last_bytes = 0
+        self.last_filename = None
+        self.lock = threading.Lock()
+        self.throttle = throttle_monitor.detector()
         
     def __call__(self, d):
+        if d['status'] == 'downloading':
+            # Every transfer path reports here, so this is where jobs draw from the shared bandwidth
+            downloaded = d.get('downloaded_bytes') or 0
+            with self.lock:
+                if d.get('filename') != self.last_filename:
+                    # Next stream of a sequential merge: its count starts over
+                    self.last_filename = d.get('filename')
+                    self.last_bytes = 0
+                # Fragment threads can report out of order; never count bytes twice
+                delta = max(0, downloaded - self.last_bytes)
+                self.last_bytes = max(self.last_bytes, downloaded)
+                throttled_speed = self.throttle.sample(delta, bandwidth.allocation(self.download_id))
+            if throttled_speed is not None:
+                # Abort this transfer; download_thread_func resumes it with a fresh URL
+                raise Throttled(f'{format_speed(throttled_speed)} over the last {throttle_monitor.window:g}s')
+            bandwidth.consume(self.download_id, delta)
+        
         current_time = time.time()
         
-        # Only update every 0.5 seconds to avoid too frequent updates
-        if current_time - self.last_update < 0.5:
+        # Only update every 0.5 seconds to avoid too frequent updates; status changes always go through
+        if d['status'] == 'downloading' and current_time - self.last_update < 0.5:
             return
             
         self.last_update = current_time
@@ -515,6 +842,8 @@ class ProgressHook:
             else:
                 percent = 0
                 
+            allocation = bandwidth.allocation(self.download_id)
+            
             # Update progress
             download_progress[self.download_id] = {
                 'status': 'downloading',
@@ -523,8 +852,10 @@ class ProgressHook:
                 'total': total,
                 'speed': speed or 0,
                 'eta': eta or 0,
+                'allocation': allocation,
                 'speed_text': format_speed(speed),
                 'eta_text': format_eta(eta),
+                'allocation_text': format_speed(allocation) if allocation else "Unlimited",
                 'file_size': format_bytes(total) if total > 0 else "-- MB"
             }
             
@@ -552,11 +883,246 @@ class ProgressHook:
                 'file_size': "-- MB"
             }
 
-def download_thread_func(url, ydl_opts, download_id):
+def mark_completed(download_id, file_path, cached=False):
+    """Record a finished download so /progress and /download_file can serve it"""
+    file_size = os.path.getsize(file_path)
+    download_progress[download_id] = {
+        'status': 'completed',
+        'percent': 100,
+        'filename': os.path.basename(file_path),
+        'filepath': os.path.relpath(file_path, 'downloads'),
+        'cached': cached,
+        'total': file_size,
+        'speed': 0,
+        'eta': 0,
+        'speed_text': "Completed",
+        'eta_text': "Done",
+        'file_size': format_bytes(file_size)
+    }
+
+def can_segment(fmt):
+    """Whether a selected format can be fetched in byte ranges instead of through yt-dlp"""
+    # Conversions run afterwards on the post-processing pool, so they do not matter here
+    return (SEGMENTED_CONNECTIONS > 1
+            and fmt.get('protocol') in ('http', 'https')
+            and bool(fmt.get('filesize')))
+
+def component_key(video_id, format_id):
+    """Component cache key of one raw stream"""
+    return OutputCache.make_key(video_id, {'format': format_id})
+
+def link_cached_component(video_id, format_id, target):
+    """Link a cached stream to target in the job's scratch directory; False when not cached"""
+    cached = component_cache.get(component_key(video_id, format_id))
+    if cached is None:
+        return False
+    # The job gets its own link, so eviction cannot pull the file away mid-merge
+    if not os.path.exists(target):
+        link_or_copy(cached, target)
+    return True
+
+def cache_component(video_id, format_id, path):
+    """Keep a downloaded stream for later jobs, leaving the job's file in place"""
+    key = component_key(video_id, format_id)
+    if component_cache.get(key) is None:
+        component_cache.store(key, path, keep_original=True)
+
+class OutputHook:
+    """yt-dlp post hook that receives the final file once merging/transcoding is done"""
+    def __init__(self, download_id=None, output_key=None):
+        self.download_id = download_id
+        self.output_key = output_key
+        self.filepath = None
+        
+    def __call__(self, filepath):
+        # Move the file out of the job's scratch directory into the output cache
+        if self.output_key:
+            filepath = output_cache.store(self.output_key, filepath)
+        self.filepath = filepath
+        
+        # Report completion right away instead of after yt-dlp returns
+        if self.download_id:
+            mark_completed(self.download_id, filepath)
+
+def fetch_formats(url, ydl_opts, download_id, scratch_dir, progress_hook, transcode=None):
+    """Download the selected formats into scratch_dir and return (paths, processed).
+    
+    Two paths (video first) mean the components still need to be merged.
+    transcode is the (codec, quality) of an audio conversion; when a CPU slot
+    is free it runs while the file downloads and processed is True.
+    Throttled transfers are resumed from fresh stream URLs.
+    """
+    # yt-dlp only reports where it put the file
+    fetch_hook = OutputHook()
+    ydl_opts['post_hooks'] = [fetch_hook]
+    
+    # Reuse the /extract result when cached
+    video_id = extract_video_id(url)
+    info = get_cached_info(video_id)
+    
+    fast_path = PARALLEL_STREAMS or SEGMENTED_CONNECTIONS > 1
+    segmented = None
+    pipeline = None
+    resumes = 0
+    # Streams that finished before a throttled transfer is resumed, by format id
+    finished = {}
+    
+    try:
+        while True:
+            used_fast_path = False
+            try:
+                # Pick the formats up front to decide how they are transferred
+                components = []
+                if fast_path:
+                    if info is None:
+                        info = extract_reusable_info(url)
+                    components = select_formats(info, ydl_opts['format'])
+                
+                if len(components) == 1:
+                    path = os.path.join(scratch_dir, f"{sanitize_filename(info.get('title') or 'video')}.{components[0]['ext']}")
+                    # Audio for a conversion is a raw stream that merges and other conversions share
+                    if transcode and link_cached_component(video_id, components[0]['format_id'], path):
+                        return [path], False
+                
+                if len(components) > 1 and PARALLEL_STREAMS and shutil.which('ffmpeg'):
+                    # Merged formats: fetch the video and audio streams at the same time
+                    used_fast_path = True
+                    components = sorted(components, key=lambda f: f.get('vcodec') in (None, 'none'))
+                    title = sanitize_filename(info.get('title') or 'video')
+                    paths = {}
+                    missing = []
+                    for f in components:
+                        # Streams another job already fetched (usually the audio) are not downloaded again
+                        target = os.path.join(scratch_dir, f"{title}.f{f['format_id']}.{f['ext']}")
+                        if f['format_id'] in finished:
+                            paths[f['format_id']] = finished[f['format_id']]
+                        elif link_cached_component(video_id, f['format_id'], target):
+                            paths[f['format_id']] = target
+                        else:
+                            missing.append(f)
+                    if missing:
+                        parallel = ParallelStreamDownload(ydl_opts, info, missing, progress_hook)
+                        try:
+                            parallel.run(scratch_dir)
+                        finally:
+                            # yt-dlp overwrites finished files on a rerun; only the unfinished stream is resumed
+                            finished.update(parallel.completed())
+                        for f in parallel.formats:
+                            cache_component(video_id, f['format_id'], finished[f['format_id']])
+                            paths[f['format_id']] = finished[f['format_id']]
+                    return [paths[f['format_id']] for f in components], False
+                elif len(components) == 1 and can_segment(components[0]):
+                    # Single file: fetch byte ranges over several connections
+                    used_fast_path = True
+                    fmt = components[0]
+                    if segmented is not None and segmented.total_bytes == fmt['filesize']:
+                        # Same file behind a fresh URL: only the missing ranges are fetched
+                        segmented.url = fmt['url']
+                    else:
+                        # A different file: an encode or the partial data of the old one is no use
+                        abort_pipelined_transcode(pipeline)
+                        if segmented is not None:
+                            segmented.discard()
+                        segmented = SegmentedDownload(fmt['url'], fmt['filesize'], path, fmt.get('http_headers'),
+                                                      SEGMENTED_CONNECTIONS, SEGMENT_SIZE, progress_callback=progress_hook)
+                        pipeline = start_pipelined_transcode(segmented, transcode)
+                    path = segmented.run()
+                    if transcode:
+                        cache_component(video_id, fmt['format_id'], path)
+                    if pipeline is None:
+                        return [path], False
+                    # Most of the audio is encoded by now; only the tail is left
+                    pipeline, (transcoder, output) = None, pipeline
+                    try:
+                        transcoder.finish()
+                        return [output], True
+                    except PostProcessError as e:
+                        # The downloaded file is complete; let the pool convert it the usual way
+                        print(f"Pipelined transcode failed for {download_id}: {e}")
+                        return [path], False
+                    finally:
+                        pipeline_slots.release()
+                else:
+                    if segmented is not None:
+                        # yt-dlp would take our preallocated part file for one of its own
+                        abort_pipelined_transcode(pipeline)
+                        pipeline = None
+                        segmented.discard()
+                        segmented = None
+                    # yt-dlp keeps .part files in the scratch directory, so a rerun resumes them
+                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        # Download the video/audio
+                        run_download(ydl, url, info)
+                    return ([fetch_hook.filepath] if fetch_hook.filepath else []), False
+            except Throttled as e:
+                if resumes >= throttle_monitor.max_resumes:
+                    throttle_monitor.record(resumed=False)
+                    raise
+                throttle_monitor.record(resumed=True)
+                resumes += 1
+                print(f"Download {download_id} throttled ({e}), resuming with a fresh stream URL")
+                info = extract_reusable_info(url)
+                progress_hook.throttle.reset()
+            except (yt_dlp.utils.DownloadError, SegmentError, requests.RequestException) as e:
+                if not used_fast_path:
+                    raise
+                # Most likely expired stream URLs; let yt-dlp start over from a fresh extraction
+                print(f"Fast download path failed for {download_id}, falling back to yt-dlp: {e}")
+                fast_path = False
+                info = None
+                abort_pipelined_transcode(pipeline)
+                pipeline = None
+                if segmented is not None:
+                    # Its part file is mostly preallocated zeros; yt-dlp must not resume from it
+                    segmented.discard()
+                    segmented = None
+    finally:
+        abort_pipelined_transcode(pipeline)
+
+def start_pipelined_transcode(segmented, transcode):
+    """Start encoding a segmented download as it arrives; returns (transcoder, output) or None.
+    
+    Remuxes and jobs that find every pipelined slot busy are left to the post-processing pool.
+    """
+    if not transcode or not PIPELINED_TRANSCODE or not PIPELINED_TRANSCODE_SLOTS:
+        return None
+    codec, quality = transcode
+    if is_passthrough(segmented.path, codec) or not pipeline_slots.acquire(blocking=False):
+        return None
+    try:
+        command, output = audio_command(segmented.path, codec, quality, from_pipe=True)
+        return StreamingTranscode(command, segmented.part_path, segmented.contiguous_bytes,
+                                  renamed_to=segmented.path), output
+    except Exception:
+        pipeline_slots.release()
+        raise
+
+def abort_pipelined_transcode(pipeline):
+    """Stop an encode started by start_pipelined_transcode and free its slot"""
+    if pipeline is not None:
+        pipeline[0].abort()
+        pipeline_slots.release()
+
+def postprocess_command(paths, postprocessors):
+    """ffmpeg command and output path for the fetched files, or None if they are final"""
+    if len(paths) > 1:
+        # <title>.f137.mp4 + <title>.f140.m4a -> <title>.mp4
+        output = re.sub(r'\.f[^.]+$', '', os.path.splitext(paths[0])[0]) + '.mp4'
+        return merge_command(paths, output), output
+    
+    for pp in postprocessors:
+        if pp.get('key') == 'FFmpegExtractAudio':
+            return audio_command(paths[0], pp.get('preferredcodec', 'mp3'), pp.get('preferredquality'))
+    return None
+
+def download_thread_func(url, ydl_opts, download_id, output_key=None):
     """Function to handle download in a separate thread"""
+    # Each job writes into its own scratch directory
+    scratch_dir = output_cache.scratch_dir(download_id)
+    ydl_opts['outtmpl'] = os.path.join(scratch_dir, '%(title)s.%(ext)s')
+    handed_over = False
+    
     try:
-        downloads_dir = 'downloads'
-        
         # Initialize progress
         download_progress[download_id] = {
             'status': 'starting',
@@ -569,104 +1135,24 @@ def download_thread_func(url, ydl_opts, download_id):
         # Create a progress hook instance
         progress_hook = ProgressHook(download_id)
         ydl_opts['progress_hooks'] = [progress_hook]
+        ydl_opts['concurrent_fragment_downloads'] = FRAGMENT_CONCURRENCY
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # First, extract info to get the video title
-            info = ydl.extract_info(url, download=False)
-            video_title = info.get('title', 'Unknown')
-            
-            # Determine expected file extension based on format type
-            format_type = 'mp3' if ydl_opts.get('postprocessors') else 'mp4'
-            expected_extension = '.mp3' if format_type == 'mp3' else '.mp4'
-            
-            # Get list of files before download
-            files_before = set()
-            if os.path.exists(downloads_dir):
-                files_before = set(os.listdir(downloads_dir))
-            
-            # Update status to show we're starting the download
-            download_progress[download_id]['status'] = 'downloading'
-            download_progress[download_id]['speed_text'] = "Initializing..."
-            
-            # Download the video/audio
-            ydl.download([url])
+        # ffmpeg work runs on the post-processing pool, not in this download worker
+        postprocessors = ydl_opts.pop('postprocessors', None) or []
         
-        # Wait longer for MP3 processing to complete
-        if format_type == 'mp3':
-            time.sleep(3)  # Extra time for audio conversion
-        else:
-            time.sleep(1)
+        # Audio-only jobs are small; their weight lets them finish quickly next to large video jobs
+        audio_only = any(pp.get('key') == 'FFmpegExtractAudio' for pp in postprocessors)
+        bandwidth.register(download_id, 'audio' if audio_only else 'video')
         
-        # Find the actual file that was created
-        final_filename = None
+        # Update status to show we're starting the download
+        download_progress[download_id] = dict(download_progress.get(download_id, {}),
+                                              status='downloading', speed_text="Initializing...")
         
-        if os.path.exists(downloads_dir):
-            files_after = set(os.listdir(downloads_dir))
-            
-            # First, look for new files with the correct extension
-            new_files = files_after - files_before
-            for new_file in new_files:
-                if new_file.endswith(expected_extension):
-                    final_filename = new_file
-                    print(f"Found new file with correct extension: {final_filename}")
-                    break
-            
-            # If no new file found, look for existing files that match the title
-            if not final_filename:
-                # Clean the title for basic matching
-                clean_title = re.sub(r'[<>:"/\\|?*？：]', '', video_title)
-                
-                # Look for files that contain parts of the title with correct extension
-                for filename in os.listdir(downloads_dir):
-                    if filename.endswith(expected_extension):
-                        # Check if the filename contains significant parts of the title
-                        filename_clean = re.sub(r'[<>:"/\\|?*？：]', '', filename)
-                        title_words = clean_title.split()
-                        
-                        # If at least 3 words from the title are in the filename, it's likely a match
-                        if len(title_words) >= 3:
-                            matches = sum(1 for word in title_words if len(word) > 2 and word.lower() in filename_clean.lower())
-                            if matches >= 3:
-                                final_filename = filename
-                                print(f"Found file by title matching: {final_filename}")
-                                break
-                        elif len(title_words) < 3:
-                            # For short titles, be more lenient
-                            if clean_title.lower() in filename_clean.lower():
-                                final_filename = filename
-                                print(f"Found file by title matching (short): {final_filename}")
-                                break
-        
-        # Update progress with completion status
-        if final_filename:
-            file_path = os.path.join(downloads_dir, final_filename)
-            if os.path.exists(file_path):
-                file_size = os.path.getsize(file_path)
-                
-                download_progress[download_id] = {
-                    'status': 'completed',
-                    'percent': 100,
-                    'filename': final_filename,
-                    'total': file_size,
-                    'speed': 0,
-                    'eta': 0,
-                    'speed_text': "Completed",
-                    'eta_text': "Done",
-                    'file_size': format_bytes(file_size)
-                }
-                
-                print(f"Download completed: {final_filename} ({file_size} bytes)")
-            else:
-                print(f"Error: Final file not found: {final_filename}")
-                download_progress[download_id] = {
-                    'status': 'error',
-                    'percent': 0,
-                    'error': f'Final file not found: {final_filename}',
-                    'speed_text': "Error",
-                    'eta_text': "Failed",
-                    'file_size': "-- MB"
-                }
-        else:
+        transcode = next(((pp.get('preferredcodec', 'mp3'), pp.get('preferredquality'))
+                          for pp in postprocessors if pp.get('key') == 'FFmpegExtractAudio'), None)
+        paths, processed = fetch_formats(url, ydl_opts, download_id, scratch_dir, progress_hook, transcode)
+        
+        if not paths:
             print(f"Error: No downloaded file found for download {download_id}")
             download_progress[download_id] = {
                 'status': 'error',
@@ -676,6 +1162,26 @@ def download_thread_func(url, ydl_opts, download_id):
                 'eta_text': "Failed",
                 'file_size': "-- MB"
             }
+            return
+        
+        task = None if processed else postprocess_command(paths, postprocessors)
+        if task is None:
+            output_hook = OutputHook(download_id, output_key)
+            output_hook(paths[0])
+            print(f"Download completed: {output_hook.filepath} ({os.path.getsize(output_hook.filepath)} bytes)")
+            return
+        
+        # Hand the files to the post-processing pool; this worker moves on to the next download
+        download_progress[download_id] = dict(download_progress.get(download_id, {}), status='processing-queued',
+                                              percent=99, speed_text="Waiting for processing...")
+        while True:
+            try:
+                postprocess_queue.submit(download_id, download_id, task, output_key, scratch_dir)
+                break
+            except QueueFull:
+                # Slow down downloads until the pool catches up
+                time.sleep(1)
+        handed_over = True
             
     except Exception as e:
         print(f"Error in download_thread_func: {e}")
@@ -687,13 +1193,92 @@ def download_thread_func(url, ydl_opts, download_id):
             'eta_text': "Failed",
             'file_size': "-- MB"
         }
+    finally:
+        bandwidth.unregister(download_id)
+        if not handed_over:
+            if output_key:
+                output_cache.release(output_key)
+            # Drop partial files and intermediate streams left by failed jobs
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def postprocess_thread_func(download_id, task, output_key, scratch_dir):
+    """Run a job's ffmpeg step (merge or audio conversion) on the post-processing pool"""
+    command, output = task
+    try:
+        download_progress[download_id] = dict(download_progress.get(download_id, {}), status='processing',
+                                              percent=99, speed_text="Processing...", eta_text="Almost done")
+        with ffmpeg_slots:
+            run_ffmpeg(command)
+        output_hook = OutputHook(download_id, output_key)
+        output_hook(output)
+        print(f"Download completed: {output_hook.filepath} ({os.path.getsize(output_hook.filepath)} bytes)")
+    except Exception as e:
+        print(f"Error in postprocess_thread_func: {e}")
+        download_progress[download_id] = {
+            'status': 'error',
+            'percent': 0,
+            'error': str(e),
+            'speed_text': "Error",
+            'eta_text': "Failed",
+            'file_size': "-- MB"
+        }
+    finally:
+        if output_key:
+            output_cache.release(output_key)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+postprocess_queue = JobQueue(postprocess_thread_func, workers=POSTPROCESS_WORKERS,
+                             max_size=POSTPROCESS_QUEUE_SIZE, name='postprocess', default_duration=10.0,
+                             tracker=job_tracker)
+
+download_queue = JobQueue(download_thread_func, workers=DOWNLOAD_WORKERS,
+                          max_size=DOWNLOAD_QUEUE_SIZE, name='download', tracker=job_tracker)
+
+def start_download_job(url, video_id, ydl_opts):
+    """Queue a download and return (download_id, status).
+    
+    Outputs that are already cached complete immediately, and a request for an
+    output another job is producing attaches to that job. Raises QueueFull.
+    """
+    download_id = uuid.uuid4().hex
+    
+    # Identical requests are served from the output cache
+    output_key = OutputCache.make_key(video_id, ydl_opts)
+    cached_output = output_cache.get(output_key)
+    if cached_output:
+        mark_completed(download_id, cached_output, cached=True)
+        return download_id, 'completed'
+    
+    # ...or attach to the job that is already producing the same output
+    owner_id = output_cache.claim(output_key, download_id)
+    if owner_id != download_id:
+        return owner_id, download_progress.get(owner_id, {}).get('status', 'queued')
+    
+    # Initialize progress
+    download_progress[download_id] = {
+        'status': 'queued',
+        'percent': 0,
+        'total': 0,
+        'speed': 0,
+        'eta': 0
+    }
+    
+    # Hand the download to the worker pool
+    try:
+        download_queue.submit(download_id, url, ydl_opts, download_id, output_key)
+    except QueueFull:
+        download_progress.pop(download_id, None)
+        output_cache.release(output_key)
+        raise
+    
+    return download_id, 'queued'
 
 @app.route('/download', methods=['POST'])
 def download_video():
     data = request.get_json()
     url = data.get('url', '').strip()
     quality = data.get('quality', 'best')
-    format_type = data.get('format', 'mp4')  # 'mp4' or 'mp3'
+    format_type = data.get('format', 'mp4')  # 'mp4', 'mp3', 'm4a' or 'opus'
     
     if not url:
         return jsonify({'error': 'Please provide a YouTube URL'}), 400
@@ -701,18 +1286,15 @@ def download_video():
     if not is_valid_youtube_url(url):
         return jsonify({'error': 'Please provide a valid YouTube URL'}), 400
     
-    # Generate unique download ID
-    download_id = str(int(time.time() * 1000))
-    
     # Create downloads directory if it doesn't exist
     downloads_dir = 'downloads'
     if not os.path.exists(downloads_dir):
         os.makedirs(downloads_dir)
     
     # Configure format selector based on download type with direct format codes
-    if format_type == 'mp3':
-        # For MP3, extract audio only
-        format_selector = 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best'
+    if format_type in AUDIO_OUTPUTS:
+        # For audio, download the audio stream only
+        format_selector = AUDIO_OUTPUTS[format_type][0]
     else:
         # For MP4, use specific format codes that work better
         quality_lower = quality.lower()
@@ -741,15 +1323,6 @@ def download_video():
             # Default fallback
             format_selector = 'best[ext=mp4]/best'
     
-    # Initialize progress
-    download_progress[download_id] = {
-        'status': 'starting',
-        'percent': 0,
-        'total': 0,
-        'speed': 0,
-        'eta': 0
-    }
-    
     # Simplified yt-dlp configuration to avoid errors
     ydl_opts = {
         'format': format_selector,
@@ -762,6 +1335,7 @@ def download_video():
         'fragment_retries': 5,
         'skip_unavailable_fragments': True,
         'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+        'cachedir': YTDLP_CACHE_DIR,
     }
     
     # Debug output
@@ -769,34 +1343,55 @@ def download_video():
     print(f"DEBUG: Format selector: {format_selector}")
     print(f"DEBUG: Format type: {format_type}")
     
-    # Add audio extraction options for MP3
-    if format_type == 'mp3':
-        ydl_opts.update({
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-        })
+    # Add audio extraction options (MP3 transcode, M4A/Opus remux)
+    if format_type in AUDIO_OUTPUTS:
+        ydl_opts.update(audio_ydl_opts(format_type))
     
-    # Start download in a separate thread
-    download_thread = threading.Thread(target=download_thread_func, args=(url, ydl_opts, download_id))
-    download_thread.daemon = True
-    download_thread.start()
+    # Hand the download to the worker pool (download ids are UUIDs; timestamps collide under bursts)
+    try:
+        download_id, status = start_download_job(url, extract_video_id(url), ydl_opts)
+    except QueueFull:
+        return jsonify({'error': 'Server is busy, please try again in a few minutes'}), 503
     
-    return jsonify({'download_id': download_id, 'status': 'started'})
+    return jsonify({
+        'download_id': download_id,
+        'status': status,
+        'queue_position': download_queue.position(download_id),
+        'estimated_wait': round(download_queue.estimated_wait(download_id))
+    })
 
-@app.route('/progress/<download_id>')
-def get_progress(download_id):
-    progress = download_progress.get(download_id, {'status': 'not_found'})
-    
+def format_progress(download_id, progress):
+    """Shape a progress entry the way /progress and the event stream return it"""
     # Format the progress data for frontend consumption
-    if progress.get('status') == 'downloading':
+    if progress.get('status') == 'queued':
+        estimated_wait = download_queue.estimated_wait(download_id)
+        formatted_progress = {
+            'status': 'queued',
+            'progress': 0,
+            'queue_position': download_queue.position(download_id),
+            'estimated_wait': round(estimated_wait),
+            'speed': 'Queued',
+            'eta': format_eta(estimated_wait),
+            'file_size': progress.get('file_size', '-- MB')
+        }
+    elif progress.get('status') == 'downloading':
         formatted_progress = {
             'status': 'downloading',
             'progress': progress.get('percent', 0),
             'speed': progress.get('speed_text', '0 B/s'),
             'eta': progress.get('eta_text', '0s'),
+            'bandwidth': progress.get('allocation_text', 'Unlimited'),
+            'file_size': progress.get('file_size', '-- MB')
+        }
+    elif progress.get('status') == 'processing-queued':
+        estimated_wait = postprocess_queue.estimated_wait(download_id)
+        formatted_progress = {
+            'status': 'processing-queued',
+            'progress': 99,
+            'queue_position': postprocess_queue.position(download_id),
+            'estimated_wait': round(estimated_wait),
+            'speed': 'Waiting for processing',
+            'eta': format_eta(estimated_wait),
             'file_size': progress.get('file_size', '-- MB')
         }
     elif progress.get('status') == 'processing':
@@ -843,7 +1438,62 @@ def get_progress(download_id):
             'file_size': '--'
         }
     
-    return jsonify(formatted_progress)
+    return formatted_progress
+
+@app.route('/progress/<download_id>')
+def get_progress(download_id):
+    progress = download_progress.get(download_id, {'status': 'not_found'})
+    return jsonify(format_progress(download_id, progress))
+
+# Statuses after which a download's progress no longer changes
+FINAL_PROGRESS_STATUSES = ('completed', 'finished', 'error', 'not_found')
+
+@app.route('/progress/<download_id>/events')
+def progress_events(download_id):
+    """Server-Sent Events stream of progress updates for one download"""
+    # EventSource sends Last-Event-ID when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '0')
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        last_event_id = 0
+    
+    def generate():
+        last_id = last_event_id
+        last_payload = None
+        last_write = time.time()
+        yield 'retry: 3000\n\n'
+        
+        while True:
+            events = download_progress.events_since(download_id, last_id, PROGRESS_STREAM_WAIT)
+            for event_id, progress in events:
+                last_id = event_id
+                last_payload = format_progress(download_id, progress)
+                last_write = time.time()
+                yield f"id: {event_id}\nevent: progress\ndata: {json.dumps(last_payload)}\n\n"
+            
+            progress = download_progress.get(download_id, {'status': 'not_found'})
+            payload = format_progress(download_id, progress)
+            
+            # Queue position moves without progress writes, and a client resuming
+            # after the final event still needs to see the final state once
+            if payload != last_payload:
+                last_payload = payload
+                last_write = time.time()
+                yield f"event: progress\ndata: {json.dumps(payload)}\n\n"
+            
+            if payload['status'] in FINAL_PROGRESS_STATUSES:
+                return
+            
+            if time.time() - last_write >= PROGRESS_STREAM_HEARTBEAT:
+                last_write = time.time()
+                yield ': heartbeat\n\n'
+    
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 def get_video_info(url):
     try:
@@ -865,35 +1515,35 @@ def get_video_info(url):
             'format': 'best',  # Use best available format to get info
             'noplaylist': True,
             'ignoreerrors': True,
+            'cachedir': YTDLP_CACHE_DIR,
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            if not info:
-                return None
-                
-            video_id = info.get('id')
-            title = info.get('title', 'Unknown')
-            duration = info.get('duration')
-            thumbnail = info.get('thumbnail')
-            
-            # Cache the video info
-            video_cache[video_id] = {
-                'title': title,
-                'duration': duration,
-                'thumbnail': thumbnail,
-                'url': url,
-                'formats': format_options
-            }
+        info = extraction_pool.extract(ydl_opts, url)
+        
+        if not info:
+            return None
             
-            return {
-                'video_id': video_id,
-                'title': title,
-                'duration': duration,
-                'thumbnail': thumbnail,
-                'formats': format_options
-            }
+        video_id = info.get('id')
+        title = info.get('title', 'Unknown')
+        duration = info.get('duration')
+        thumbnail = info.get('thumbnail')
+        
+        # Cache the video info
+        video_cache.set(video_id, {
+            'title': title,
+            'duration': duration,
+            'thumbnail': thumbnail,
+            'url': url,
+            'formats': format_options
+        })
+        
+        return {
+            'video_id': video_id,
+            'title': title,
+            'duration': duration,
+            'thumbnail': thumbnail,
+            'formats': format_options
+        }
             
     except Exception as e:
         print(f"Error extracting video info: {e}")
@@ -932,7 +1582,7 @@ def download_file(download_id):
     if not progress or progress['status'] not in ['finished', 'completed']:
         return jsonify({'error': 'Download not completed'}), 400
     
-    filename = progress.get('filename')
+    filename = progress.get('filepath') or progress.get('filename')
     if not filename:
         return jsonify({'error': 'No filename available'}), 400
     
@@ -940,10 +1590,30 @@ def download_file(download_id):
     full_path = os.path.join(downloads_dir, filename)
     
     if os.path.exists(full_path):
-        return send_file(full_path, as_attachment=True)
+        # ?stream=true lets the browser play the file instead of saving it
+        stream_mode = request.args.get('stream', 'false').lower() == 'true'
+        return file_delivery.send(full_path, as_attachment=not stream_mode)
     else:
         return jsonify({'error': f'File not found: {filename}'}), 404
 
+@app.route('/metrics')
+def metrics():
+    """Cache and queue counters for monitoring"""
+    return jsonify({
+        'video_cache': video_cache.stats(),
+        'video_store': video_store.stats() if video_store else None,
+        'output_cache': output_cache.stats(),
+        'component_cache': component_cache.stats(),
+        'delivery': file_delivery.stats(),
+        'extract': extract_flight.stats(),
+        'extraction_pool': extraction_pool.stats(),
+        'ydl_pool': ydl_pool.stats(),
+        'bandwidth': bandwidth.stats(),
+        'throttle': throttle_monitor.stats(),
+        'download_queue': download_queue.stats(),
+        'postprocess_queue': postprocess_queue.stats()
+    })
+
 if __name__ == '__main__':
     # For production, remove debug=True and use proper WSGI server
     app.run(debug=False, host='0.0.0.0', port=8000) 
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""Bandwidth sharing between running downloads"""
+import threading
+import time
+
+
+class _Share:
+    def __init__(self, kind, weight, cap):
+        self.kind = kind
+        self.weight = weight
+        self.cap = cap
+        self.rate = None
+        self.tokens = 0.0
+        self.refilled = time.time()
+        self.last_used = time.time()
+        self.consumed = 0
+
+
+class BandwidthManager:
+    """Split a global transfer rate between downloads by weight.
+
+    Every running job owns a token bucket refilled at its allocation. The
+    allocations are recomputed by water-filling: jobs whose cap is below
+    their weighted share get their cap, the rest is divided among the others
+    by weight. Jobs that have not transferred anything for idle_after
+    seconds (merging, transcoding) give their share back to the others.
+
+    With host (a SharedBandwidth) rate is the limit of every process on the
+    host together. Each process then publishes the weight of its active jobs
+    and uses the part of rate that matches its share of the host's total
+    weight, so the split between processes follows the load.
+
+    rate and caps are in bytes per second; 0 means unlimited.
+    """
+
+    def __init__(self, rate=0, job_cap=0, weights=None, idle_after=2.0, rebalance_interval=1.0, host=None):
+        self.host_rate = rate
+        self.rate = rate
+        self.host = host
+        self.job_cap = job_cap
+        self.weights = dict(weights or {})
+        self.idle_after = idle_after
+        self.rebalance_interval = rebalance_interval
+
+        self._lock = threading.Lock()
+        self._shares = {}
+        self._rebalanced = 0
+        self._synced = 0
+        self.throttled_seconds = 0.0
+
+    def register(self, job_id, kind, cap=None):
+        """Give a job a share of the bandwidth; cap overrides the per-job default"""
+        with self._lock:
+            self._shares[job_id] = _Share(kind, self.weights.get(kind, 1.0), cap or self.job_cap)
+            self._rebalance()
+        self._sync(force=True)
+
+    def unregister(self, job_id):
+        with self._lock:
+            if self._shares.pop(job_id, None) is None:
+                return
+            self._rebalance()
+        self._sync(force=True)
+
+    def consume(self, job_id, nbytes):
+        """Account for nbytes transferred by a job, sleeping while it is over its allocation"""
+        self._sync()
+        with self._lock:
+            share = self._shares.get(job_id)
+            if share is None:
+                return
+            now = time.time()
+            was_idle = now - share.last_used > self.idle_after
+            share.last_used = now
+            share.consumed += nbytes
+            if was_idle or now - self._rebalanced > self.rebalance_interval:
+                self._rebalance()
+            if not share.rate:
+                return
+
+            # Refill, allowing at most one second of burst, then go into debt
+            share.tokens = min(share.rate, share.tokens + (now - share.refilled) * share.rate)
+            share.refilled = now
+            share.tokens -= nbytes
+            delay = -share.tokens / share.rate if share.tokens < 0 else 0
+            self.throttled_seconds += delay
+
+        if delay:
+            time.sleep(delay)
+
+    def allocation(self, job_id):
+        """Bytes per second currently allotted to a job, or None when unlimited"""
+        with self._lock:
+            share = self._shares.get(job_id)
+            return share.rate if share else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'host_rate': self.host_rate,
+                'job_cap': self.job_cap,
+                'weights': dict(self.weights),
+                'throttled_seconds': round(self.throttled_seconds, 1),
+                'jobs': {
+                    job_id: {
+                        'kind': share.kind,
+                        'weight': share.weight,
+                        'allocation': share.rate,
+                        'consumed': share.consumed,
+                    }
+                    for job_id, share in self._shares.items()
+                },
+            }
+
+    def _sync(self, force=False):
+        # Publish this process's active weight and take its part of the host rate.
+        # The shared store is written outside self._lock, at most once per interval.
+        if self.host is None or not self.host_rate:
+            return
+        with self._lock:
+            now = time.time()
+            if not force and now - self._synced < self.rebalance_interval:
+                return
+            self._synced = now
+            weight = sum(s.weight for s in self._shares.values() if now - s.last_used <= self.idle_after)
+        total = self.host.publish(weight)
+        with self._lock:
+            # Until other processes report, or when the store fails, this process may use all of it
+            self.rate = self.host_rate * weight / total if weight and total else self.host_rate
+            self._rebalance()
+
+    def _rebalance(self):
+        # Callers hold self._lock
+        now = time.time()
+        self._rebalanced = now
+        active = [s for s in self._shares.values() if now - s.last_used <= self.idle_after]
+        for share in self._shares.values():
+            share.rate = share.cap or None
+
+        if not self.rate:
+            return
+
+        remaining = self.rate
+        pending = active
+        while pending:
+            total_weight = sum(s.weight for s in pending)
+            capped = [s for s in pending if s.cap and s.cap <= remaining * s.weight / total_weight]
+            if not capped:
+                for share in pending:
+                    share.rate = remaining * share.weight / total_weight
+                break
+            for share in capped:
+                remaining -= share.cap
+            pending = [s for s in pending if s not in capped]
+
+        # Idle jobs keep a minimal trickle until they are rebalanced on their next transfer
+        for share in self._shares.values():
+            if share not in active:
+                share.rate = min(share.cap or self.rate, self.rate / max(1, len(self._shares)))
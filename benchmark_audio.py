@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Compare the CPU cost of MP3 transcoding with M4A/Opus passthrough.
+
+Runs the same ffmpeg commands the post-processing pool uses on local audio
+files and reports CPU and wall time per job.
+
+    python benchmark_audio.py song.m4a song.webm --runs 5
+    python benchmark_audio.py --generate 300
+
+--generate creates AAC and Opus test files of the given length in seconds
+(needs an ffmpeg built with libopus).
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from postprocess import audio_command, run_ffmpeg
+
+
+def generate_sources(directory, seconds):
+    """Synthesize an AAC .m4a and an Opus .webm like YouTube's itags 140 and 251"""
+    tone = ['-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={seconds}', '-ac', '2']
+    sources = []
+    for name, codec in (('generated.m4a', ['-c:a', 'aac', '-b:a', '128k']),
+                        ('generated.webm', ['-c:a', 'libopus', '-b:a', '160k'])):
+        path = os.path.join(directory, name)
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *tone, *codec, path],
+                       check=True)
+        sources.append(path)
+    return sources
+
+
+def measure(command):
+    """Run one ffmpeg job and return (cpu seconds, wall seconds)"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    run_ffmpeg(command)
+    wall = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return cpu, wall
+
+
+def jobs_for(source):
+    """The output paths /download can produce from this source"""
+    ext = os.path.splitext(source)[1].lstrip('.')
+    jobs = [('mp3 transcode', 'mp3', '192')]
+    if ext in ('m4a', 'mp4'):
+        jobs.append(('m4a passthrough', 'm4a', None))
+    if ext in ('webm', 'opus', 'ogg'):
+        jobs.append(('opus passthrough', 'opus', None))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='*', help='audio files as downloaded from YouTube (.m4a, .webm)')
+    parser.add_argument('--runs', type=int, default=3, help='repetitions per job (default: 3)')
+    parser.add_argument('--generate', type=float, metavar='SECONDS', help='benchmark generated test files instead')
+    args = parser.parse_args()
+
+    if not shutil.which('ffmpeg'):
+        sys.exit('ffmpeg is not installed')
+
+    workdir = tempfile.mkdtemp(prefix='audio-benchmark-')
+    try:
+        sources = list(args.sources)
+        if args.generate:
+            sources += generate_sources(workdir, args.generate)
+        if not sources:
+            parser.error('give audio files or --generate SECONDS')
+
+        print(f"{'source':<28} {'job':<18} {'cpu s/job':>10} {'wall s/job':>11}")
+        for source in sources:
+            for label, codec, quality in jobs_for(source):
+                cpu_total = wall_total = 0.0
+                for run in range(args.runs):
+                    # Work on a copy so outputs never land next to the user's files
+                    copy = os.path.join(workdir, f'run{run}', os.path.basename(source))
+                    os.makedirs(os.path.dirname(copy), exist_ok=True)
+                    shutil.copyfile(source, copy)
+                    command, output = audio_command(copy, codec, quality)
+                    cpu, wall = measure(command)
+                    cpu_total += cpu
+                    wall_total += wall
+                    shutil.rmtree(os.path.dirname(copy))
+                print(f'{os.path.basename(source)[:28]:<28} {label:<18} '
+                      f'{cpu_total / args.runs:>10.3f} {wall_total / args.runs:>11.3f}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
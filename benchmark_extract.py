@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compare the lite extraction profile with yt-dlp's full default extraction.
+
+Extracts the same videos with both profiles and reports wall time and HTTP
+requests per extraction, plus the formats /extract needs that were found.
+
+    python benchmark_extract.py dQw4w9WgXcQ jNQXAC9IVRw --runs 3
+    EXTRACT_PLAYER_CLIENTS=tv,web python benchmark_extract.py dQw4w9WgXcQ
+
+Each video gets one untimed extraction per profile first, and all runs share
+one cache directory, so downloading and solving the player JS is not counted.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yt_dlp
+
+from extraction_profiles import PROFILES, extract_opts, parse_player_clients
+
+# Heights /extract offers and the audio itags M4A/Opus/MP3 downloads use
+OFFERED_HEIGHTS = (2160, 1440, 1080, 720, 480, 360)
+AUDIO_ITAGS = ('140', '251')
+
+
+def extract(ydl_opts, url):
+    """Extract url with a fresh YoutubeDL; returns (info, seconds, http requests)"""
+    requests = 0
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        urlopen = ydl.urlopen
+
+        def counting_urlopen(req):
+            nonlocal requests
+            requests += 1
+            return urlopen(req)
+
+        # Extractors send every request through their YoutubeDL's urlopen
+        ydl.urlopen = counting_urlopen
+        started = time.perf_counter()
+        info = ydl.extract_info(url, download=False)
+        return info, time.perf_counter() - started, requests
+
+
+def coverage(info):
+    """Offered heights and audio itags present in an info dict"""
+    formats = info.get('formats') or []
+    heights = {f.get('height') for f in formats if f.get('vcodec') != 'none' and f.get('height')}
+    offered = [h for h in OFFERED_HEIGHTS if any(height >= h for height in heights)]
+    audio = [itag for itag in AUDIO_ITAGS if any(f.get('format_id') == itag for f in formats)]
+    return len(formats), offered, audio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('videos', nargs='+', help='YouTube video ids or URLs')
+    parser.add_argument('--runs', type=int, default=3, help='timed extractions per profile and video (default: 3)')
+    args = parser.parse_args()
+
+    player_clients = parse_player_clients(os.environ.get('EXTRACT_PLAYER_CLIENTS'))
+    cachedir = tempfile.mkdtemp(prefix='extract-benchmark-')
+    try:
+        print(f"lite player clients: {','.join(player_clients) or 'yt-dlp default'}")
+        print(f"{'video':<14} {'profile':<8} {'s/extract':>10} {'requests':>9} {'formats':>8}  offered heights / audio")
+        for video in args.videos:
+            url = video if '/' in video else f'https://www.youtube.com/watch?v={video}'
+            for profile in PROFILES:
+                ydl_opts = {**extract_opts(profile, player_clients), 'cachedir': cachedir}
+                try:
+                    extract(ydl_opts, url)
+                    results = [extract(ydl_opts, url) for _ in range(args.runs)]
+                except yt_dlp.utils.DownloadError as e:
+                    print(f'{video[:14]:<14} {profile:<8} failed: {e}', file=sys.stderr)
+                    continue
+                seconds = sum(r[1] for r in results) / len(results)
+                requests = sum(r[2] for r in results) / len(results)
+                count, offered, audio = coverage(results[-1][0])
+                print(f'{video[:14]:<14} {profile:<8} {seconds:>10.2f} {requests:>9.1f} {count:>8}  '
+                      f"{','.join(map(str, offered)) or '-'} / {','.join(audio) or '-'}")
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Bounded in-memory cache for video extraction results"""
+import collections
+import json
+import threading
+import time
+
+
+class CachedError(Exception):
+    """Raised on a lookup that hits a negative (failed extraction) entry"""
+
+
+class _Entry:
+    __slots__ = ('value', 'error', 'size', 'expires', 'stale_until')
+
+    def __init__(self, value, error, size, expires, stale_until):
+        self.value = value
+        self.error = error
+        self.size = size
+        self.expires = expires
+        self.stale_until = stale_until
+
+
+class ExtractionCache:
+    """LRU cache with an entry and byte budget, per-entry TTL and negative entries.
+
+    Once an entry passes its TTL it is still served for up to stale_ttl
+    seconds while refresh(key) runs in a background thread
+    (stale-while-revalidate). After that it is treated as a miss.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=128 * 1024 * 1024, ttl=3600,
+                 stale_ttl=1800, negative_ttl=120, refresh=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Return the cached value, None on a miss, or raise CachedError for a negative entry"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now >= entry.stale_until:
+                if entry is not None:
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+
+            if entry.error is not None:
+                self.negative_hits += 1
+                raise CachedError(entry.error)
+
+            if now < entry.expires:
+                self.hits += 1
+                return entry.value
+
+            self.stale_hits += 1
+            start_refresh = self.refresh is not None and key not in self._refreshing
+            if start_refresh:
+                self._refreshing.add(key)
+
+        if start_refresh:
+            thread = threading.Thread(target=self._run_refresh, args=(key,))
+            thread.daemon = True
+            thread.start()
+        return entry.value
+
+    def peek(self, key):
+        """Return a fresh value without touching counters, LRU order or refreshes"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.error is not None or time.time() >= entry.expires:
+                return None
+            return entry.value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl
+        self._store(key, _Entry(value, None, self._size_of(value), expires, expires + self.stale_ttl))
+
+    def set_error(self, key, message):
+        """Remember that extraction for key failed, for negative_ttl seconds"""
+        expires = time.time() + self.negative_ttl
+        self._store(key, _Entry(None, message, len(message), expires, expires))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry.value
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'refreshing': len(self._refreshing),
+            }
+
+    def _store(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.bytes += entry.size
+            self._refreshing.discard(key)
+
+            # Evict least recently used entries until we are back within budget,
+            # always keeping the entry that was just stored
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    def _run_refresh(self, key):
+        try:
+            self.refresh(key)
+        except Exception as e:
+            print(f"Background refresh failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    @staticmethod
+    def _size_of(value):
+        # The serialized size is a good approximation of an entry's footprint
+        return len(json.dumps(value, default=str))
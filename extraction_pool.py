@@ -0,0 +1,220 @@
+"""yt-dlp extraction in long-lived worker processes, away from the web server's GIL"""
+import multiprocessing
+import queue
+import threading
+
+import yt_dlp
+
+from ydl_pool import YoutubeDLPool
+
+# Large parts of an info dict that downloads never need
+HEAVY_INFO_KEYS = ('automatic_captions', 'subtitles', 'thumbnails', 'heatmap')
+
+
+class ExtractionTimeout(Exception):
+    """Raised when an extraction does not finish within the pool's timeout"""
+
+
+class ExtractionError(Exception):
+    """Raised when a worker process dies or fails outside of yt-dlp"""
+
+
+class _WorkerGone(ExtractionError):
+    """The worker process exited; its pipe is broken"""
+
+
+def make_reusable_info(info):
+    """Reduce an extract_info result to a JSON-safe dict that can be downloaded later"""
+    reusable = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    for key in HEAVY_INFO_KEYS:
+        reusable.pop(key, None)
+    return reusable
+
+
+def extract_info(ydl_opts, url, instances):
+    """Extract url without downloading and return the reduced info dict, or None"""
+    with instances.checkout(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    return make_reusable_info(info) if info else None
+
+
+def _serve(conn):
+    # Worker process loop: one (ydl_opts, url) task in, one small result tuple out.
+    # YoutubeDL instances and their connections live as long as the process.
+    instances = YoutubeDLPool(max_idle=1)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        ydl_opts, url = task
+        try:
+            result = ('ok', extract_info(ydl_opts, url, instances))
+        except yt_dlp.utils.DownloadError as e:
+            result = ('download_error', str(e))
+        except Exception as e:
+            result = ('error', f'{type(e).__name__}: {e}')
+        conn.send(result)
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn,), name='extraction-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class ExtractionPool:
+    """Run extractions on a fixed number of worker processes.
+
+    The pure-Python parts of extract_info (JSON parsing, signature solving,
+    format sorting) then no longer compete for the GIL with request threads;
+    a caller only sends the task and blocks on the pipe. Workers reduce the
+    info dict before sending it back. A task that runs past timeout seconds
+    has its worker killed, and every worker is replaced after max_tasks
+    extractions so leaks cannot build up. A caller waits at most timeout
+    seconds for a free worker before ExtractionTimeout is raised. With
+    workers=0 extractions run in the calling thread.
+    """
+
+    def __init__(self, workers=2, timeout=60.0, max_tasks=100, start_method='forkserver'):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = 'spawn'
+        self._context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            # Children fork from a server that has yt-dlp imported already
+            self._context.set_forkserver_preload([__name__])
+        self._slots = threading.BoundedSemaphore(max(1, workers))
+        self._idle = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        # Used when extracting in the calling thread
+        self._instances = YoutubeDLPool()
+        self.busy = 0
+        self.started = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.recycled = 0
+        self.rejected = 0
+
+    def extract(self, ydl_opts, url, timeout=None):
+        """Extract url with ydl_opts and return the reduced info dict.
+
+        Raises yt_dlp.utils.DownloadError like extract_info would,
+        ExtractionTimeout, or ExtractionError.
+        """
+        if not self.workers:
+            return extract_info(ydl_opts, url, self._instances)
+
+        timeout = timeout or self.timeout
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            raise ExtractionTimeout(f'No extraction worker became free within {timeout:g} seconds')
+        with self._lock:
+            self.busy += 1
+        try:
+            for attempt in range(2):
+                worker = self._checkout()
+                try:
+                    status, value = self._run(worker, (ydl_opts, url), timeout)
+                except _WorkerGone as e:
+                    worker.stop(kill=True)
+                    if worker.tasks and not attempt:
+                        # An idle worker that died since its last task; try a fresh one
+                        continue
+                    raise ExtractionError(str(e))
+                except BaseException:
+                    # Killed or interrupted mid-task: never hand this worker out again
+                    worker.stop(kill=True)
+                    raise
+                self._checkin(worker)
+                break
+        finally:
+            with self._lock:
+                self.busy -= 1
+            self._slots.release()
+
+        if status == 'ok':
+            return value
+        if status == 'download_error':
+            raise yt_dlp.utils.DownloadError(value)
+        raise ExtractionError(value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'started': self.started,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'crashes': self.crashes,
+                'recycled': self.recycled,
+                'rejected': self.rejected,
+            }
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        # Processes are started lazily, in the gunicorn worker that uses them
+        worker = _Worker(self._context)
+        with self._lock:
+            self.started += 1
+        return worker
+
+    def _checkin(self, worker):
+        worker.tasks += 1
+        if self.max_tasks and worker.tasks >= self.max_tasks:
+            worker.stop()
+            with self._lock:
+                self.recycled += 1
+        else:
+            self._idle.put(worker)
+
+    def _run(self, worker, task, timeout):
+        try:
+            worker.conn.send(task)
+        except OSError:
+            with self._lock:
+                self.crashes += 1
+            raise _WorkerGone(f'Extraction worker exited with code {worker.process.exitcode}')
+        if not worker.conn.poll(timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise ExtractionTimeout(f'Extraction took longer than {timeout:g} seconds')
+        try:
+            result = worker.conn.recv()
+        except (EOFError, OSError):
+            # EOF, or a reset when the worker died with the task still unread
+            with self._lock:
+                self.crashes += 1
+            raise _WorkerGone(f'Extraction worker exited with code {worker.process.exitcode}')
+        with self._lock:
+            self.completed += 1
+        return result
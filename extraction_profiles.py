@@ -0,0 +1,45 @@
+"""yt-dlp option profiles for extracting video information"""
+
+PROFILES = ('lite', 'full')
+
+# Player clients asked for streams by the lite profile. tv lists every adaptive
+# format up to 4K, including itags 140 and 251; check benchmark_extract.py's
+# format coverage after upgrading yt-dlp.
+DEFAULT_PLAYER_CLIENTS = ('tv',)
+
+
+def parse_player_clients(value):
+    """Split a comma-separated EXTRACT_PLAYER_CLIENTS value; empty leaves the choice to yt-dlp"""
+    if value is None:
+        return list(DEFAULT_PLAYER_CLIENTS)
+    return [client.strip() for client in value.split(',') if client.strip()]
+
+
+def extract_opts(profile='lite', player_clients=DEFAULT_PLAYER_CLIENTS):
+    """yt-dlp options for reading a video's metadata and formats.
+
+    full is yt-dlp's default extraction. lite asks only player_clients for
+    streams and skips what /extract never uses: HLS and DASH manifests (the
+    player response already lists the adaptive formats of a regular video),
+    translated subtitle lists and playlists in the URL. Live streams only
+    have manifest formats and need the full profile.
+    """
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+    }
+    if profile == 'full':
+        return opts
+    if profile != 'lite':
+        raise ValueError(f"Unknown extraction profile {profile!r}, expected one of {', '.join(PROFILES)}")
+
+    youtube_args = {'skip': ['hls', 'dash', 'translated_subs']}
+    if player_clients:
+        youtube_args['player_client'] = list(player_clients)
+    opts.update({
+        'noplaylist': True,
+        'getcomments': False,
+        'writesubtitles': False,
+        'extractor_args': {'youtube': youtube_args},
+    })
+    return opts
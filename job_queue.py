@@ -0,0 +1,138 @@
+"""Bounded job queue served by a fixed pool of worker threads"""
+import collections
+import threading
+import time
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted to a queue that has no room left"""
+
+
+class JobQueue:
+    """Run submitted jobs on a fixed number of worker threads.
+
+    Jobs wait in FIFO order until a worker is free, so queue position and
+    an estimated wait can be reported while a job is still pending.
+
+    With a tracker (state_store.SharedJobTracker) every job is also recorded
+    host-wide, so any server process can report the position of a job that
+    another process accepted.
+    """
+
+    def __init__(self, handler, workers=2, max_size=50, name='jobs', default_duration=30.0, tracker=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.name = name
+        self.default_duration = default_duration
+        self.tracker = tracker
+
+        self._pending = collections.deque()
+        self._args = {}
+        self._active = set()
+        self._durations = collections.deque(maxlen=50)
+        self._cond = threading.Condition()
+        self._threads = []
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, job_id, *args):
+        """Queue a job and return its 1-based position, or raise QueueFull"""
+        with self._cond:
+            if len(self._pending) >= self.max_size:
+                self.rejected += 1
+                raise QueueFull(f'{self.name} queue is full ({self.max_size} jobs waiting)')
+
+            self._start_workers()
+            self._pending.append(job_id)
+            self._args[job_id] = args
+            if self.tracker:
+                self.tracker.queued(self.name, job_id)
+            self._cond.notify()
+            return len(self._pending)
+
+    def position(self, job_id):
+        """Return the 1-based queue position of a pending job, or None"""
+        if self.tracker:
+            return self.tracker.position(self.name, job_id)
+        with self._cond:
+            try:
+                return self._pending.index(job_id) + 1
+            except ValueError:
+                return None
+
+    def average_duration(self):
+        """Average run time of recently finished jobs in seconds"""
+        with self._cond:
+            if not self._durations:
+                return self.default_duration
+            return sum(self._durations) / len(self._durations)
+
+    def estimated_wait(self, job_id):
+        """Estimate the seconds until a pending job is picked up by a worker"""
+        position = self.position(job_id)
+        if position is None:
+            return 0
+
+        if self.tracker:
+            _, active, workers = self.tracker.counts(self.name)
+            jobs_ahead = position - 1 + active
+            return (jobs_ahead // max(1, workers)) * self.average_duration()
+
+        with self._cond:
+            jobs_ahead = position - 1 + len(self._active)
+        return (jobs_ahead // self.workers) * self.average_duration()
+
+    def stats(self):
+        """Snapshot of queue depth and worker usage"""
+        with self._cond:
+            stats = {
+                'workers': self.workers,
+                'active': len(self._active),
+                'queued': len(self._pending),
+                'max_size': self.max_size,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+        if self.tracker:
+            queued, active, workers = self.tracker.counts(self.name)
+            stats['host'] = {'workers': workers, 'active': active, 'queued': queued}
+        return stats
+
+    def _start_workers(self):
+        # Threads are started lazily so that forking servers (gunicorn) start
+        # them in the worker process that actually serves requests.
+        if self._threads:
+            return
+
+        if self.tracker:
+            self.tracker.register(self.name, self.workers)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'{self.name}-worker-{i}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job_id = self._pending.popleft()
+                args = self._args.pop(job_id)
+                self._active.add(job_id)
+
+            started = time.time()
+            try:
+                if self.tracker:
+                    self.tracker.started(self.name, job_id)
+                self.handler(*args)
+            except Exception as e:
+                print(f"Error in {self.name} worker for job {job_id}: {e}")
+            finally:
+                if self.tracker:
+                    self.tracker.finished(self.name, job_id)
+                with self._cond:
+                    self._active.discard(job_id)
+                    self._durations.append(time.time() - started)
+                    self.completed += 1
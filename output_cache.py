@@ -0,0 +1,233 @@
+"""Content-addressed cache of finished download outputs"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from state_store import SQLiteState, owner_alive, process_token
+
+
+def link_or_copy(source, target):
+    """Hard-link source to target, copying when the filesystem does not allow it"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class OutputCache:
+    """Finished files indexed by what produced them.
+
+    The key is a hash of the video id and every yt-dlp option that changes
+    the output bytes (format selector, merge container, postprocessors).
+    Each key owns one directory under root; the SQLite index records the
+    finished file and is shared by all workers on the host, and so are the
+    claims of jobs producing an output. Least recently used outputs are
+    deleted once max_bytes is exceeded or after ttl.
+    """
+
+    # yt-dlp options that affect the produced file
+    KEY_OPTIONS = ('format', 'merge_output_format', 'postprocessors')
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS outputs ('
+        ' key TEXT PRIMARY KEY,'
+        ' path TEXT NOT NULL,'
+        ' size INTEGER NOT NULL,'
+        ' created REAL NOT NULL,'
+        ' last_access REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS claims ('
+        ' key TEXT PRIMARY KEY,'
+        ' job_id TEXT NOT NULL,'
+        ' pid INTEGER NOT NULL,'
+        ' owner TEXT)',
+    )
+    MIGRATIONS = (
+        ('claims', 'owner', 'TEXT'),
+    )
+
+    def __init__(self, root, index_path, max_bytes=20 * 1024 ** 3, ttl=24 * 3600):
+        self.root = root
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.attached = 0
+        self.evictions = 0
+        self.errors = 0
+
+        os.makedirs(root, exist_ok=True)
+        self.db = SQLiteState(index_path, self.SCHEMA, self.MIGRATIONS)
+
+    @classmethod
+    def make_key(cls, video_id, ydl_opts):
+        """Hash the video id and output-affecting options into a cache key"""
+        material = {'video_id': video_id}
+        for option in cls.KEY_OPTIONS:
+            material[option] = ydl_opts.get(option)
+        encoded = json.dumps(material, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def scratch_dir(self, job_id):
+        """Private working directory for one job, on the same filesystem as the cache"""
+        path = os.path.join(self.root, '.scratch', job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def store(self, key, path, keep_original=False):
+        """Move a finished file into the directory for key, record it and return its new path.
+
+        With keep_original the file is hard-linked (or copied) instead, so the
+        caller keeps using its own path.
+        """
+        directory = os.path.join(self.root, key)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        final_path = os.path.join(directory, os.path.basename(path))
+        if keep_original:
+            link_or_copy(path, final_path)
+        else:
+            os.replace(path, final_path)
+        self.put(key, final_path)
+        return final_path
+
+    def get(self, key):
+        """Return the path of a finished output for key, or None"""
+        try:
+            conn = self.db.connect()
+            row = conn.execute('SELECT path, size, created FROM outputs WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                path, size, created = row
+                if time.time() - created < self.ttl and os.path.isfile(path) and os.path.getsize(path) == size:
+                    with conn:
+                        conn.execute('UPDATE outputs SET last_access = ? WHERE key = ?', (time.time(), key))
+                    with self._lock:
+                        self.hits += 1
+                    return path
+                # The file was removed or replaced behind our back
+                with conn:
+                    directories = self._remove(conn, key)
+                self._delete(directories)
+        except sqlite3.Error as e:
+            self._record_error('read', e)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, path):
+        """Record a finished output and evict old ones if over budget"""
+        now = time.time()
+        try:
+            conn = self.db.connect()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO outputs (key, path, size, created, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (key, path, os.path.getsize(path), now, now)
+                )
+            self._evict(conn, keep=key)
+        except sqlite3.Error as e:
+            # The file stays where it is; it is just not reused
+            self._record_error('write', e)
+
+    def claim(self, key, job_id):
+        """Register job_id as the producer of key.
+
+        Returns job_id if it now owns the key, or the id of the job that is
+        already producing it, possibly in another worker process. Claims of
+        processes that died are taken over, even if their pid was reused.
+        When the index cannot be written the job runs on its own.
+        """
+        token = process_token()
+        try:
+            conn = self.db.connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT job_id, owner FROM claims WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[1] and (row[1] == token or owner_alive(row[1])):
+                    owner = row[0]
+                else:
+                    conn.execute('INSERT OR REPLACE INTO claims (key, job_id, pid, owner) VALUES (?, ?, ?, ?)',
+                                 (key, job_id, os.getpid(), token))
+                    owner = job_id
+        except sqlite3.Error as e:
+            self._record_error('claim', e)
+            return job_id
+        if owner != job_id:
+            with self._lock:
+                self.attached += 1
+        return owner
+
+    def release(self, key):
+        try:
+            conn = self.db.connect()
+            with conn:
+                conn.execute('DELETE FROM claims WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            # Left behind, the claim is taken over once this process is gone
+            self._record_error('release', e)
+
+    def stats(self):
+        try:
+            conn = self.db.connect()
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outputs').fetchone()
+            in_flight = conn.execute('SELECT COUNT(*) FROM claims').fetchone()[0]
+        except sqlite3.Error:
+            entries = size = in_flight = None
+        with self._lock:
+            return {
+                'entries': entries,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'in_flight': in_flight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'attached': self.attached,
+                'evictions': self.evictions,
+                'errors': self.errors,
+            }
+
+    def _evict(self, conn, keep=None):
+        directories = []
+        with conn:
+            expired = conn.execute(
+                'SELECT key FROM outputs WHERE created < ? AND key != ?', (time.time() - self.ttl, keep or '')
+            ).fetchall()
+            for (key,) in expired:
+                directories += self._remove(conn, key)
+
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM outputs').fetchone()[0]
+            if total > self.max_bytes:
+                rows = conn.execute(
+                    'SELECT key, size FROM outputs WHERE key != ? ORDER BY last_access', (keep or '',)
+                ).fetchall()
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    directories += self._remove(conn, key)
+                    total -= size
+        # Deleted after the commit, so the write lock is not held during disk I/O
+        self._delete(directories)
+
+    def _remove(self, conn, key):
+        # Returns the directories to delete once the transaction is committed
+        conn.execute('DELETE FROM outputs WHERE key = ?', (key,))
+        producing = conn.execute('SELECT 1 FROM claims WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            self.evictions += 1
+        return [] if producing else [os.path.join(self.root, key)]
+
+    def _delete(self, directories):
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _record_error(self, action, error):
+        with self._lock:
+            self.errors += 1
+        print(f"Output cache {action} failed ({self.index_path}): {error}")
@@ -0,0 +1,102 @@
+"""Download the video and audio streams of a merged format at the same time"""
+import copy
+import os
+import threading
+
+import yt_dlp
+
+
+class ParallelStreamDownload:
+    """Fetch each requested format in its own thread.
+
+    yt-dlp downloads the components of 'video+audio' selections one after
+    the other; here both transfers run concurrently and their progress is
+    reported as one combined stream through progress_callback, which gets
+    yt-dlp style progress dicts. Muxing the components is left to the caller.
+    """
+
+    def __init__(self, ydl_opts, info, formats, progress_callback):
+        self.ydl_opts = ydl_opts
+        self.info = info
+        # Video first, so the merge can map input 0 to video and input 1 to audio
+        self.formats = sorted(formats, key=lambda f: f.get('vcodec') in (None, 'none'))
+        self.progress_callback = progress_callback
+
+        self._lock = threading.Lock()
+        self._progress = {}
+        self._paths = {}
+        self._errors = []
+
+    def run(self, scratch_dir):
+        """Download all components into scratch_dir and return their paths, video first"""
+        threads = []
+        for f in self.formats:
+            thread = threading.Thread(target=self._download_component, args=(f['format_id'], scratch_dir),
+                                      name=f"component-{f['format_id']}")
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+        self.progress_callback(self._combined('finished'))
+        return [self._paths[f['format_id']] for f in self.formats]
+
+    def completed(self):
+        """Paths of the components that finished, by format id, even if run() failed"""
+        with self._lock:
+            return dict(self._paths)
+
+    def _download_component(self, format_id, scratch_dir):
+        opts = dict(self.ydl_opts)
+        opts.update({
+            'format': format_id,
+            # Named like yt-dlp's own intermediate files: <title>.f<format_id>.<ext>
+            'outtmpl': os.path.join(scratch_dir, f'%(title)s.f{format_id}.%(ext)s'),
+            'merge_output_format': None,
+            'postprocessors': [],
+            'progress_hooks': [lambda d: self._on_progress(format_id, d)],
+            'post_hooks': [lambda path: self._finished(format_id, path)],
+        })
+        try:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                ydl.process_ie_result(copy.deepcopy(self.info), download=True)
+            if format_id not in self._paths:
+                raise yt_dlp.utils.DownloadError(f'Component {format_id} produced no file')
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+
+    def _finished(self, format_id, path):
+        with self._lock:
+            self._paths[format_id] = path
+
+    def _on_progress(self, format_id, d):
+        with self._lock:
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            downloaded = total if d['status'] == 'finished' else d.get('downloaded_bytes', 0)
+            self._progress[format_id] = {
+                'downloaded': downloaded,
+                'total': total,
+                'speed': (d.get('speed') or 0) if d['status'] == 'downloading' else 0,
+            }
+            if d['status'] != 'downloading':
+                return
+            # Reported under the lock so the callback sees byte counts in order
+            self.progress_callback(self._combined('downloading'))
+
+    def _combined(self, status):
+        downloaded = sum(p['downloaded'] for p in self._progress.values())
+        total = sum(p['total'] for p in self._progress.values())
+        speed = sum(p['speed'] for p in self._progress.values())
+        eta = (total - downloaded) / speed if speed and total > downloaded else 0
+        return {
+            'status': status,
+            'downloaded_bytes': downloaded,
+            'total_bytes': total,
+            'speed': speed,
+            'eta': eta,
+        }
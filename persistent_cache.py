@@ -0,0 +1,123 @@
+"""On-disk cache tier shared by every worker process on the host"""
+import json
+import sqlite3
+import threading
+import time
+
+from state_store import SQLiteState
+
+
+class PersistentCache:
+    """Key/value store in a SQLite database running in WAL mode.
+
+    WAL lets several gunicorn workers read while one writes, and the data
+    survives restarts. Expired rows are removed by compact(), which runs at
+    most once every compact_interval seconds from set().
+    """
+
+    SCHEMA = (
+        # auto_vacuum only takes effect on a database without tables
+        'PRAGMA auto_vacuum=INCREMENTAL',
+        'CREATE TABLE IF NOT EXISTS entries ('
+        ' key TEXT PRIMARY KEY,'
+        ' value TEXT NOT NULL,'
+        ' expires REAL NOT NULL,'
+        ' updated REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)',
+    )
+
+    def __init__(self, path, ttl=6 * 3600, max_entries=20000, compact_interval=600):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.compact_interval = compact_interval
+
+        self._lock = threading.Lock()
+        self._last_compact = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self.db = SQLiteState(path, self.SCHEMA)
+
+    def get(self, key):
+        """Return (value, seconds_left) for a live entry, or None"""
+        try:
+            row = self.db.connect().execute(
+                'SELECT value, expires FROM entries WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self._record_error('read', e)
+            return None
+
+        now = time.time()
+        if row is None or row[1] <= now:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0]), row[1] - now
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        try:
+            conn = self.db.connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, value, expires, updated) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + ttl, now)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            self._record_error('write', e)
+            return
+
+        if now - self._last_compact >= self.compact_interval:
+            self.compact()
+
+    def delete(self, key):
+        try:
+            conn = self.db.connect()
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            conn.commit()
+        except sqlite3.Error as e:
+            self._record_error('delete', e)
+
+    def compact(self):
+        """Drop expired rows, trim to max_entries and give free pages back to the OS"""
+        with self._lock:
+            self._last_compact = time.time()
+        try:
+            conn = self.db.connect()
+            conn.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+            conn.execute(
+                'DELETE FROM entries WHERE key IN ('
+                ' SELECT key FROM entries ORDER BY updated DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            conn.commit()
+            conn.execute('PRAGMA incremental_vacuum')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            self._record_error('compact', e)
+
+    def stats(self):
+        try:
+            entries = self.db.connect().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        with self._lock:
+            return {
+                'path': self.path,
+                'entries': entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+            }
+
+    def _record_error(self, action, error):
+        with self._lock:
+            self.errors += 1
+        print(f"Persistent cache {action} failed ({self.path}): {error}")
@@ -0,0 +1,175 @@
+"""ffmpeg commands for the post-processing stage of a download"""
+import os
+import subprocess
+import threading
+
+
+class PostProcessError(Exception):
+    """Raised when ffmpeg fails to produce the output file"""
+
+
+# Encoder and file extension per audio codec yt-dlp's FFmpegExtractAudio accepts
+AUDIO_CODECS = {
+    'mp3': ('libmp3lame', 'mp3'),
+    'aac': ('aac', 'm4a'),
+    'm4a': ('aac', 'm4a'),
+    'opus': ('libopus', 'opus'),
+    'vorbis': ('libvorbis', 'ogg'),
+    'flac': ('flac', 'flac'),
+    'wav': ('pcm_s16le', 'wav'),
+}
+
+# Downloaded file extensions that already hold the codec; these are only remuxed
+PASSTHROUGH_SOURCES = {
+    'm4a': ('m4a', 'mp4'),
+    'aac': ('m4a', 'mp4'),
+    'opus': ('webm', 'opus', 'ogg'),
+}
+
+
+def _base_command(ffmpeg):
+    return [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y']
+
+
+def merge_command(sources, output, ffmpeg='ffmpeg'):
+    """Mux a video-only and an audio-only file into output without re-encoding"""
+    command = _base_command(ffmpeg)
+    for source in sources:
+        command += ['-i', source]
+    return command + ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', '-movflags', '+faststart', output]
+
+
+def is_passthrough(source, codec):
+    """Whether source already holds codec, so conversion is only a remux"""
+    return os.path.splitext(source)[1].lstrip('.') in PASSTHROUGH_SOURCES.get(codec, ())
+
+
+def audio_command(source, codec='mp3', quality='192', ffmpeg='ffmpeg', from_pipe=False):
+    """Convert source to an audio file the way FFmpegExtractAudio would; returns (command, output).
+
+    When source already holds the codec the stream is copied into the
+    target container instead of being decoded and encoded again. With
+    from_pipe ffmpeg reads the source bytes from stdin.
+    """
+    encoder, ext = AUDIO_CODECS[codec]
+    base, source_ext = os.path.splitext(source)
+    output = base + '.' + ext
+    if output == source:
+        # Same container: write the remuxed file into a subdirectory under the same name
+        directory = os.path.join(os.path.dirname(source), 'remux')
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, os.path.basename(source))
+
+    source_arg = 'pipe:0' if from_pipe else source
+    if is_passthrough(source, codec):
+        command = _base_command(ffmpeg) + ['-i', source_arg, '-vn', '-c:a', 'copy']
+        if ext == 'm4a':
+            command += ['-movflags', '+faststart']
+        return command + [output], output
+
+    command = _base_command(ffmpeg) + ['-i', source_arg, '-vn', '-c:a', encoder]
+    if quality:
+        # Like yt-dlp: small numbers are VBR quality levels, larger ones bitrates in kbit/s
+        quality = float(quality)
+        command += ['-q:a', f'{quality:g}'] if quality < 10 else ['-b:a', f'{quality:g}k']
+    return command + [output], output
+
+
+def run_ffmpeg(command):
+    """Run an ffmpeg command and raise PostProcessError if it fails"""
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise PostProcessError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()[-500:]}")
+
+
+class StreamingTranscode:
+    """Feed a file to ffmpeg's stdin while it is still being downloaded.
+
+    available() returns how many bytes from the start of source are already
+    written; a feeder thread follows it, so encoding overlaps the transfer
+    and a slow encoder never holds up the download. Call finish() once the
+    download is complete, or abort() to give up. renamed_to is where source
+    ends up once the download completes, if it is renamed.
+    """
+
+    def __init__(self, command, source, available, chunk_size=256 * 1024, poll_interval=0.2, renamed_to=None):
+        self.source = source
+        self.renamed_to = renamed_to
+        self.available = available
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.fed = 0
+
+        self._complete = threading.Event()
+        self._error = None
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        # Drain stderr so a chatty ffmpeg cannot block on a full pipe
+        self._stderr = []
+        self._stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_thread.start()
+        self._thread = threading.Thread(target=self._feed, name='transcode-feeder', daemon=True)
+        self._thread.start()
+
+    def finish(self):
+        """Feed the remaining bytes, wait for ffmpeg and raise PostProcessError if it failed"""
+        self._complete.set()
+        self._thread.join()
+        returncode = self._process.wait()
+        self._stderr_thread.join()
+        if self._error or returncode != 0:
+            detail = b''.join(self._stderr).decode('utf-8', 'replace').strip()[-500:]
+            raise PostProcessError(f'ffmpeg failed: {detail or self._error}')
+
+    def abort(self):
+        self._complete.set()
+        if self._process.poll() is None:
+            self._process.kill()
+        self._thread.join()
+        self._process.wait()
+
+    def _feed(self):
+        try:
+            # The download may not have created the file yet
+            while not self._source_exists() and not self._complete.is_set():
+                self._complete.wait(self.poll_interval)
+            if not self._source_exists() and self.available() == 0:
+                # Aborted before the first byte arrived
+                return
+            with self._open_source() as f:
+                while True:
+                    available = self.available()
+                    if available > self.fed:
+                        f.seek(self.fed)
+                        data = f.read(min(available - self.fed, self.chunk_size))
+                        self._process.stdin.write(data)
+                        self.fed += len(data)
+                    elif self._complete.is_set():
+                        # Download finished (and fully fed) or aborted
+                        break
+                    else:
+                        self._complete.wait(self.poll_interval)
+        except (BrokenPipeError, ValueError, OSError) as e:
+            # ffmpeg exited or was killed
+            self._error = e
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+    def _source_exists(self):
+        return os.path.exists(self.source) or bool(self.renamed_to and os.path.exists(self.renamed_to))
+
+    def _open_source(self):
+        try:
+            return open(self.source, 'rb')
+        except FileNotFoundError:
+            if not self.renamed_to:
+                raise
+            # The download finished before the feeder got to it
+            return open(self.renamed_to, 'rb')
+
+    def _read_stderr(self):
+        for line in self._process.stderr:
+            self._stderr.append(line)
@@ -0,0 +1,84 @@
+"""Download progress store that pushes every update to waiting subscribers"""
+import collections
+import threading
+import time
+
+
+class ProgressBroker:
+    """Dict-like store of the latest progress per download.
+
+    Every assignment is also recorded as a numbered event, so streaming
+    clients can wait for updates and resume from the last event id they saw.
+    Downloads that reached a final status are dropped once they have not
+    changed for ttl seconds.
+    """
+
+    FINAL_STATUSES = ('completed', 'finished', 'error')
+
+    def __init__(self, history=50, ttl=24 * 3600, expire_interval=600):
+        self.history = history
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self._cond = threading.Condition()
+        self._latest = {}
+        self._events = {}
+        self._last_id = {}
+        self._updated = {}
+        self._last_expire = time.time()
+
+    def __setitem__(self, download_id, progress):
+        with self._cond:
+            event_id = self._last_id.get(download_id, 0) + 1
+            self._last_id[download_id] = event_id
+            self._latest[download_id] = progress
+            events = self._events.get(download_id)
+            if events is None:
+                events = self._events[download_id] = collections.deque(maxlen=self.history)
+            events.append((event_id, progress))
+            now = time.time()
+            self._updated[download_id] = now
+            if now - self._last_expire >= self.expire_interval:
+                self._expire(now)
+            self._cond.notify_all()
+
+    def __getitem__(self, download_id):
+        with self._cond:
+            return self._latest[download_id]
+
+    def __contains__(self, download_id):
+        with self._cond:
+            return download_id in self._latest
+
+    def get(self, download_id, default=None):
+        with self._cond:
+            return self._latest.get(download_id, default)
+
+    def pop(self, download_id, default=None):
+        with self._cond:
+            self._events.pop(download_id, None)
+            self._last_id.pop(download_id, None)
+            self._updated.pop(download_id, None)
+            return self._latest.pop(download_id, default)
+
+    def last_event_id(self, download_id):
+        with self._cond:
+            return self._last_id.get(download_id, 0)
+
+    def events_since(self, download_id, last_event_id, timeout):
+        """Block up to timeout seconds for events newer than last_event_id"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id.get(download_id, 0) > last_event_id, timeout)
+            events = self._events.get(download_id, ())
+            return [(event_id, progress) for event_id, progress in events if event_id > last_event_id]
+
+    def _expire(self, now):
+        # Callers hold self._cond
+        self._last_expire = now
+        cutoff = now - self.ttl
+        expired = [download_id for download_id, updated in self._updated.items()
+                   if updated < cutoff and self._latest[download_id].get('status') in self.FINAL_STATUSES]
+        for download_id in expired:
+            del self._latest[download_id]
+            del self._updated[download_id]
+            self._events.pop(download_id, None)
+            self._last_id.pop(download_id, None)
@@ -0,0 +1,187 @@
+"""Multi-connection download of a single file using HTTP range requests"""
+import os
+import queue
+import threading
+import time
+
+import requests
+
+
+class SegmentError(Exception):
+    """Raised when a segment cannot be fetched or the server ignores range requests"""
+
+
+class SegmentedDownload:
+    """Fetch a file of known length as byte ranges over several connections.
+
+    The data goes to a preallocated part_path (path + '.part') and every
+    segment is written at its own offset with os.pwrite, so workers never
+    wait on each other. The file is renamed to path once all of it is
+    written. Each worker keeps one requests.Session, which reuses its
+    connection across segments. Progress goes to progress_callback as
+    yt-dlp style progress dicts.
+
+    When run() fails, the part file and the missing ranges are kept; calling
+    run() again (for example after replacing an expired or throttled url)
+    continues from there. discard() deletes them instead.
+    """
+
+    def __init__(self, url, total_bytes, path, headers=None, connections=4,
+                 segment_size=4 * 1024 * 1024, retries=3, progress_callback=None):
+        self.url = url
+        self.total_bytes = total_bytes
+        self.path = path
+        self.part_path = path + '.part'
+        self.headers = dict(headers or {})
+        # Byte counts must match the file, so ask for the body as stored
+        self.headers['Accept-Encoding'] = 'identity'
+        self.connections = connections
+        self.segment_size = segment_size
+        self.retries = retries
+        self.progress_callback = progress_callback
+
+        self._lock = threading.Lock()
+        self._errors = []
+        self._segments = None
+        # Offset reached within each segment, keyed by the segment's last byte
+        self._progress = {}
+        self.downloaded = 0
+        self._started = None
+        self._last_report = (0, 0)
+        self._speed = 0
+
+    def run(self):
+        """Download the missing parts of the file and return its path"""
+        segments = self._segments
+        self._errors = []
+        self._started = time.time()
+        self._last_report = (self._started, self.downloaded)
+
+        if segments is None:
+            segments = self._segments = queue.Queue()
+            for start in range(0, self.total_bytes, self.segment_size):
+                end = min(start + self.segment_size, self.total_bytes) - 1
+                segments.put((start, end))
+                self._progress[end] = start
+            fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        else:
+            fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, self.total_bytes)
+            else:
+                os.ftruncate(fd, self.total_bytes)
+
+            threads = []
+            for i in range(min(self.connections, segments.qsize())):
+                thread = threading.Thread(target=self._worker, args=(fd, segments), name=f'segment-{i}')
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(fd)
+
+        if self._errors:
+            raise self._errors[0]
+
+        os.replace(self.part_path, self.path)
+        with self._lock:
+            self._report('finished')
+        return self.path
+
+    def discard(self):
+        """Delete the part file of an unfinished download"""
+        self._segments = None
+        self._progress = {}
+        self.downloaded = 0
+        try:
+            os.remove(self.part_path)
+        except FileNotFoundError:
+            pass
+
+    def _worker(self, fd, segments):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        try:
+            while not self._errors:
+                try:
+                    start, end = segments.get_nowait()
+                except queue.Empty:
+                    return
+                self._fetch(session, fd, start, end)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+        finally:
+            session.close()
+
+    def _fetch(self, session, fd, start, end):
+        offset = start
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    # Resume a failed segment from where it broke off
+                    with session.get(self.url, headers={'Range': f'bytes={offset}-{end}'},
+                                     stream=True, timeout=30) as response:
+                        if response.status_code != 206:
+                            raise SegmentError(f'Server answered {response.status_code} to a range request')
+                        for chunk in response.iter_content(64 * 1024):
+                            chunk = memoryview(chunk)[:end + 1 - offset]
+                            while chunk:
+                                written = os.pwrite(fd, chunk, offset)
+                                chunk = chunk[written:]
+                                offset += written
+                                self._add(written, end, offset)
+                            if offset > end or self._errors:
+                                return
+                    if offset > end:
+                        return
+                    raise requests.ConnectionError(f'Segment {start}-{end} ended at byte {offset}')
+                except requests.RequestException:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(1 + attempt)
+        finally:
+            if offset <= end:
+                # Unfinished; keep the rest for the next run()
+                self._segments.put((offset, end))
+
+    def contiguous_bytes(self):
+        """Length of the part at the start of the file that is completely written"""
+        with self._lock:
+            position = 0
+            for end in sorted(self._progress):
+                if self._progress[end] <= end:
+                    return self._progress[end]
+                position = end + 1
+            return position
+
+    def _add(self, count, end, offset):
+        # Every chunk is reported, in order, while holding the lock; the
+        # callback may block to pace the transfer of all workers
+        with self._lock:
+            self._progress[end] = offset
+            self.downloaded += count
+            now = time.time()
+            last_time, last_bytes = self._last_report
+            if now - last_time >= 0.5:
+                # Speed over the last window, not the whole transfer
+                self._speed = (self.downloaded - last_bytes) / (now - last_time)
+                self._last_report = (now, self.downloaded)
+            self._report('downloading')
+
+    def _report(self, status):
+        # Callers hold self._lock
+        if not self.progress_callback:
+            return
+        speed = self._speed if status == 'downloading' else 0
+        eta = (self.total_bytes - self.downloaded) / speed if speed else 0
+        self.progress_callback({
+            'status': status,
+            'downloaded_bytes': self.downloaded,
+            'total_bytes': self.total_bytes,
+            'speed': speed,
+            'eta': eta,
+        })
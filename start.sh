@@ -14,6 +14,17 @@ fi
 PORT=${PORT:-8000}
 echo "🔧 Using PORT: $PORT"
 
+# Solve the current YouTube player once, for all workers, before serving requests
+python ytdlp_cache.py || echo "⚠️ yt-dlp cache not warmed, first extractions will be slower"
+
+# Download threads of the previous run died without releasing their jobs and claims
+python state_store.py "${STATE_PATH:-cache/state.sqlite3}" cache/outputs.sqlite3 cache/components.sqlite3
+
 # Start the application with proper port binding
 echo "🎬 Starting YouTube downloader..."
-gunicorn wsgi:app --bind 0.0.0.0:$PORT --workers 1 --timeout 300 
\ No newline at end of file
+# One worker process per core; progress and queue state are shared through cache/state.sqlite3.
+# The app reads WEB_CONCURRENCY to split ffmpeg slots and extraction processes between the workers.
+export WEB_CONCURRENCY=${WEB_CONCURRENCY:-$(nproc)}
+echo "🧵 Using $WEB_CONCURRENCY workers"
+# Threaded workers so long-lived progress streams do not block other requests
+gunicorn wsgi:app --bind 0.0.0.0:$PORT --workers $WEB_CONCURRENCY --worker-class gthread --threads ${GUNICORN_THREADS:-32} --timeout 300 
\ No newline at end of file
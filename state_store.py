@@ -0,0 +1,385 @@
+"""Job and progress state shared by every worker process on the host"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+def pid_alive(pid):
+    """Whether a process with this pid still exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_token(pid=None):
+    """'<pid>:<start time>' of a process, so a recycled pid is not mistaken for it.
+
+    The start time comes from /proc; where that is unavailable the token is
+    only '<pid>:'.
+    """
+    pid = pid or os.getpid()
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # starttime is the 22nd field; the command name before it may contain spaces
+            started = f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        started = ''
+    return f'{pid}:{started}'
+
+
+def owner_alive(token):
+    """Whether the process a process_token() was taken from is still running"""
+    pid, _, started = token.partition(':')
+    if not pid_alive(int(pid)):
+        return False
+    return not started or process_token(int(pid)) == token
+
+
+class SQLiteState:
+    """A SQLite database in WAL mode holding state that all workers must agree on.
+
+    Connections are per thread; WAL lets readers in one gunicorn worker
+    proceed while another worker writes. schema and migrations default to
+    the progress and job tables; the on-disk caches pass their own.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS progress ('
+        ' download_id TEXT PRIMARY KEY,'
+        ' event_id INTEGER NOT NULL,'
+        ' data TEXT NOT NULL,'
+        ' updated REAL NOT NULL,'
+        ' pid INTEGER,'
+        ' owner TEXT)',
+        'CREATE INDEX IF NOT EXISTS progress_updated ON progress (updated)',
+        'CREATE TABLE IF NOT EXISTS progress_events ('
+        ' download_id TEXT NOT NULL,'
+        ' event_id INTEGER NOT NULL,'
+        ' data TEXT NOT NULL,'
+        ' PRIMARY KEY (download_id, event_id))',
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        ' queue TEXT NOT NULL,'
+        ' job_id TEXT NOT NULL,'
+        ' state TEXT NOT NULL,'
+        ' enqueued REAL NOT NULL,'
+        ' pid INTEGER NOT NULL,'
+        ' owner TEXT,'
+        ' PRIMARY KEY (queue, job_id))',
+        'CREATE TABLE IF NOT EXISTS queue_workers ('
+        ' queue TEXT NOT NULL,'
+        ' pid INTEGER NOT NULL,'
+        ' workers INTEGER NOT NULL,'
+        ' owner TEXT,'
+        ' PRIMARY KEY (queue, pid))',
+        'CREATE TABLE IF NOT EXISTS bandwidth ('
+        ' owner TEXT PRIMARY KEY,'
+        ' weight REAL NOT NULL,'
+        ' updated REAL NOT NULL)',
+    )
+
+    # Columns added after a table was first released: (table, column, type)
+    MIGRATIONS = (
+        ('progress', 'pid', 'INTEGER'),
+        ('progress', 'owner', 'TEXT'),
+        ('jobs', 'owner', 'TEXT'),
+        ('queue_workers', 'owner', 'TEXT'),
+    )
+
+    def __init__(self, path, schema=None, migrations=None):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if schema is None:
+            schema, migrations = self.SCHEMA, self.MIGRATIONS
+        conn = self.connect()
+        for statement in schema:
+            conn.execute(statement)
+        for table, column, column_type in migrations or ():
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            if column not in columns:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        conn.commit()
+
+    def connect(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+
+class SharedProgressBroker:
+    """ProgressBroker with the same interface, backed by SQLiteState.
+
+    Updates from any worker are visible to all of them. Waiters in the
+    writing process are woken right away; other processes notice new events
+    by polling every poll_interval seconds. Entries not updated for ttl
+    seconds are removed.
+
+    Each entry records the process that wrote it. An unfinished download
+    whose process has died is reported as failed. A write that fails (for
+    example on a locked database) is logged and dropped, so progress hooks
+    never abort a download.
+    """
+
+    # Statuses after which the writing process no longer matters
+    FINAL_STATUSES = ('completed', 'finished', 'error')
+
+    def __init__(self, state, history=50, poll_interval=0.25, ttl=24 * 3600, expire_interval=600):
+        self.state = state
+        self.history = history
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self._cond = threading.Condition()
+        self._last_expire = 0
+        self.errors = 0
+
+    def __setitem__(self, download_id, progress):
+        data = json.dumps(progress)
+        now = time.time()
+        conn = self.state.connect()
+        try:
+            with conn:
+                # BEGIN IMMEDIATE serialises event numbering across processes
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT event_id FROM progress WHERE download_id = ?', (download_id,)).fetchone()
+                event_id = (row[0] if row else 0) + 1
+                conn.execute(
+                    'INSERT OR REPLACE INTO progress (download_id, event_id, data, updated, pid, owner)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (download_id, event_id, data, now, os.getpid(), process_token())
+                )
+                conn.execute('INSERT INTO progress_events (download_id, event_id, data) VALUES (?, ?, ?)',
+                             (download_id, event_id, data))
+                conn.execute('DELETE FROM progress_events WHERE download_id = ? AND event_id <= ?',
+                             (download_id, event_id - self.history))
+        except sqlite3.Error as e:
+            self._record_error('write', e)
+            return
+
+        with self._cond:
+            self._cond.notify_all()
+        if now - self._last_expire >= self.expire_interval:
+            self.expire()
+
+    def __getitem__(self, download_id):
+        progress = self.get(download_id)
+        if progress is None:
+            raise KeyError(download_id)
+        return progress
+
+    def __contains__(self, download_id):
+        return self.get(download_id) is not None
+
+    def get(self, download_id, default=None):
+        row = self.state.connect().execute(
+            'SELECT data, owner FROM progress WHERE download_id = ?', (download_id,)
+        ).fetchone()
+        if row is None:
+            return default
+        progress = json.loads(row[0])
+        owner = row[1]
+        if (progress.get('status') not in self.FINAL_STATUSES and owner and owner != process_token()
+                and not owner_alive(owner)):
+            # The worker running this download is gone; it will never finish
+            return {
+                'status': 'error',
+                'percent': 0,
+                'error': 'The server process running this download stopped',
+                'speed_text': "Error",
+                'eta_text': "Failed",
+                'file_size': "-- MB"
+            }
+        return progress
+
+    def pop(self, download_id, default=None):
+        progress = self.get(download_id, default)
+        conn = self.state.connect()
+        with conn:
+            conn.execute('DELETE FROM progress WHERE download_id = ?', (download_id,))
+            conn.execute('DELETE FROM progress_events WHERE download_id = ?', (download_id,))
+        return progress
+
+    def last_event_id(self, download_id):
+        row = self.state.connect().execute(
+            'SELECT event_id FROM progress WHERE download_id = ?', (download_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def events_since(self, download_id, last_event_id, timeout):
+        """Block up to timeout seconds for events newer than last_event_id"""
+        deadline = time.time() + timeout
+        while True:
+            rows = self.state.connect().execute(
+                'SELECT event_id, data FROM progress_events WHERE download_id = ? AND event_id > ?'
+                ' ORDER BY event_id', (download_id, last_event_id)
+            ).fetchall()
+            remaining = deadline - time.time()
+            if rows or remaining <= 0:
+                return [(event_id, json.loads(data)) for event_id, data in rows]
+            with self._cond:
+                self._cond.wait(min(self.poll_interval, remaining))
+
+    def expire(self):
+        """Drop progress of downloads that have not changed for ttl seconds"""
+        self._last_expire = time.time()
+        cutoff = self._last_expire - self.ttl
+        conn = self.state.connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM progress_events WHERE download_id IN'
+                             ' (SELECT download_id FROM progress WHERE updated < ?)', (cutoff,))
+                conn.execute('DELETE FROM progress WHERE updated < ?', (cutoff,))
+        except sqlite3.Error as e:
+            self._record_error('expire', e)
+
+    def _record_error(self, operation, error):
+        self.errors += 1
+        print(f"Progress store {operation} failed: {error}")
+
+
+class SharedJobTracker:
+    """Host-wide view of JobQueue contents, so any worker can report queue positions.
+
+    Each process still runs the jobs it accepted; the tracker only records
+    them. Rows left behind by processes that died are cleared when a worker
+    starts, and all rows by reset() before the server starts.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._cleanup()
+
+    def register(self, queue, workers):
+        """Record how many workers this process runs for queue"""
+        conn = self.state.connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO queue_workers (queue, pid, workers, owner) VALUES (?, ?, ?, ?)',
+                         (queue, os.getpid(), workers, process_token()))
+
+    def queued(self, queue, job_id):
+        conn = self.state.connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO jobs (queue, job_id, state, enqueued, pid, owner)'
+                         ' VALUES (?, ?, ?, ?, ?, ?)',
+                         (queue, job_id, 'queued', time.time(), os.getpid(), process_token()))
+
+    def started(self, queue, job_id):
+        conn = self.state.connect()
+        with conn:
+            conn.execute("UPDATE jobs SET state = 'running' WHERE queue = ? AND job_id = ?", (queue, job_id))
+
+    def finished(self, queue, job_id):
+        conn = self.state.connect()
+        with conn:
+            conn.execute('DELETE FROM jobs WHERE queue = ? AND job_id = ?', (queue, job_id))
+
+    def position(self, queue, job_id):
+        """1-based position among the jobs waiting in queue on this host, or None"""
+        row = self.state.connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE queue = ? AND state = 'queued' AND enqueued <="
+            " (SELECT enqueued FROM jobs WHERE queue = ? AND job_id = ? AND state = 'queued')",
+            (queue, queue, job_id)
+        ).fetchone()
+        return row[0] or None
+
+    def counts(self, queue):
+        """(queued, running, workers) for queue across all processes"""
+        conn = self.state.connect()
+        queued, running = conn.execute(
+            "SELECT COALESCE(SUM(state = 'queued'), 0), COALESCE(SUM(state = 'running'), 0)"
+            ' FROM jobs WHERE queue = ?', (queue,)
+        ).fetchone()
+        workers = conn.execute('SELECT COALESCE(SUM(workers), 0) FROM queue_workers WHERE queue = ?',
+                               (queue,)).fetchone()[0]
+        return queued, running, workers
+
+    def _cleanup(self):
+        conn = self.state.connect()
+        with conn:
+            for table in ('jobs', 'queue_workers'):
+                owners = [row[0] for row in conn.execute(f'SELECT DISTINCT owner FROM {table}')]
+                for owner in owners:
+                    if owner is None:
+                        conn.execute(f'DELETE FROM {table} WHERE owner IS NULL')
+                    elif not owner_alive(owner):
+                        conn.execute(f'DELETE FROM {table} WHERE owner = ?', (owner,))
+
+
+class SharedBandwidth:
+    """Host-wide sum of the download weights that BandwidthManagers are using.
+
+    Every process publishes the weight of its active jobs about once a
+    second; rows not updated for stale_after seconds no longer count, so
+    processes that stopped downloading or died drop out on their own.
+    """
+
+    def __init__(self, state, stale_after=5.0):
+        self.state = state
+        self.stale_after = stale_after
+        self.errors = 0
+
+    def publish(self, weight):
+        """Record this process's active weight; returns the host's total, or None on failure"""
+        now = time.time()
+        try:
+            conn = self.state.connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO bandwidth (owner, weight, updated) VALUES (?, ?, ?)',
+                             (process_token(), weight, now))
+                return conn.execute('SELECT COALESCE(SUM(weight), 0) FROM bandwidth WHERE updated >= ?',
+                                    (now - self.stale_after,)).fetchone()[0]
+        except sqlite3.Error as e:
+            self.errors += 1
+            print(f"Bandwidth share update failed: {e}")
+            return None
+
+
+def reset(path):
+    """Forget the jobs, output claims and unfinished progress a previous server run left in path.
+
+    Download threads die with their process without cleaning up, so these
+    rows would otherwise outlive a restart.
+    """
+    if not os.path.exists(path):
+        return
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        with conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for table in ('jobs', 'queue_workers', 'claims', 'bandwidth'):
+                if table in tables:
+                    conn.execute(f'DELETE FROM {table}')
+            if 'progress' in tables:
+                unfinished = [download_id for download_id, data in conn.execute('SELECT download_id, data FROM progress')
+                              if json.loads(data).get('status') not in SharedProgressBroker.FINAL_STATUSES]
+                for download_id in unfinished:
+                    conn.execute('DELETE FROM progress WHERE download_id = ?', (download_id,))
+                    conn.execute('DELETE FROM progress_events WHERE download_id = ?', (download_id,))
+    finally:
+        conn.close()
+
+
+def main():
+    # Run by start.sh before gunicorn starts: python state_store.py DATABASE...
+    for path in sys.argv[1:]:
+        reset(path)
+        print(f"Cleared jobs and claims of the previous run from {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -222,33 +222,62 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    // Poll download progress
+    // Handle a progress update pushed by the server or returned by polling
+    function handleProgress(downloadId, data) {
+        if (downloadProgress) {
+            downloadProgress.classList.remove('hidden');
+        }
+        
+        // Update progress UI
+        updateProgressUI(data);
+        
+        if (data.status === 'ready_for_download') {
+            // Trigger direct download
+            triggerDirectDownload(downloadId, data.filename);
+            showDownloadComplete(data.filename);
+        } else if (data.status === 'completed') {
+            // Download completed successfully
+            console.log('Download completed successfully');
+        } else if (data.status === 'error') {
+            // Download failed
+            console.log('Download failed:', data.error);
+        }
+    }
+
+    // Statuses that mean the download is still in progress
+    function isActiveStatus(status) {
+        return ['queued', 'starting', 'extracting', 'downloading', 'processing-queued', 'processing'].includes(status);
+    }
+
+    // Watch download progress through the Server-Sent Events stream
+    function watchProgress(downloadId) {
+        if (!window.EventSource) {
+            pollProgress(downloadId);
+            return;
+        }
+
+        // EventSource reconnects by itself and resumes from the last event id
+        const source = new EventSource(`/progress/${downloadId}/events`);
+        source.addEventListener('progress', function(event) {
+            const data = JSON.parse(event.data);
+            handleProgress(downloadId, data);
+            if (!isActiveStatus(data.status)) {
+                source.close();
+            }
+        });
+    }
+
+    // Poll download progress (fallback for browsers without EventSource)
     async function pollProgress(downloadId, pollCount = 0) {
         try {
             const response = await fetch(`/progress/${downloadId}`);
             const data = await response.json();
             
-            if (downloadProgress) {
-                downloadProgress.classList.remove('hidden');
-            }
-            
-            // Update progress UI
-            updateProgressUI(data);
+            handleProgress(downloadId, data);
             
             // Continue polling if not finished, or if we haven't received a final status yet
-            if (data.status === 'extracting' || data.status === 'downloading' || 
-                (data.status === 'starting' && pollCount < 120)) { // Max 2 minutes
+            if (isActiveStatus(data.status) && (data.status !== 'starting' || pollCount < 120)) { // Max 2 minutes
                 setTimeout(() => pollProgress(downloadId, pollCount + 1), 1000);
-            } else if (data.status === 'ready_for_download') {
-                // Trigger direct download
-                triggerDirectDownload(downloadId, data.filename);
-                showDownloadComplete(data.filename);
-            } else if (data.status === 'completed') {
-                // Download completed successfully
-                console.log('Download completed successfully');
-            } else if (data.status === 'error') {
-                // Download failed
-                console.log('Download failed:', data.error);
             }
             
         } catch (error) {
@@ -278,9 +307,11 @@ document.addEventListener('DOMContentLoaded', function() {
     // Update progress UI
     function updateProgressUI(progressData) {
         if (downloadStatus) {
-            const statusText = progressData.status === 'extracting' ? 'Extracting download URL...' : 
+            const statusText = progressData.status === 'queued' ? `Queued (position ${progressData.queue_position || 1})` :
+                               progressData.status === 'extracting' ? 'Extracting download URL...' : 
                                progressData.status === 'ready_for_download' ? 'Download ready!' :
                                progressData.status === 'downloading' ? 'Downloading...' :
+                               progressData.status === 'processing-queued' ? `Waiting for processing (position ${progressData.queue_position || 1})` :
                                progressData.status;
             downloadStatus.textContent = statusText;
         }
@@ -421,7 +452,7 @@ document.addEventListener('DOMContentLoaded', function() {
             try {
                 const url = urlInput.value.trim();
                 await downloadVideo(url, formatId, formatType);
-                pollProgress(currentDownloadId);
+                watchProgress(currentDownloadId);
             } catch (error) {
                 showError(error.message);
             }
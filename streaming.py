@@ -0,0 +1,90 @@
+"""Progressive streaming of YouTube formats through an ffmpeg pipe"""
+import subprocess
+
+
+class StreamError(Exception):
+    """Raised when ffmpeg exits before producing any output"""
+
+
+def _header_args(headers):
+    if not headers:
+        return []
+    lines = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    return ['-headers', lines]
+
+
+def build_ffmpeg_command(sources, output_format, ffmpeg='ffmpeg'):
+    """ffmpeg command that reads the source URLs and writes a streamable file to stdout.
+
+    sources is a list of (url, http_headers). Two sources are a video-only
+    and an audio-only stream that get muxed together without re-encoding.
+    output_format is 'mp4' (fragmented MP4) or 'mp3'.
+    """
+    command = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for url, headers in sources:
+        command += _header_args(headers)
+        command += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5', '-i', url]
+
+    if output_format == 'mp3':
+        command += ['-vn', '-c:a', 'libmp3lame', '-b:a', '192k', '-f', 'mp3']
+    else:
+        if len(sources) > 1:
+            command += ['-map', '0:v:0', '-map', '1:a:0']
+        # Fragmented MP4 puts the moov box up front, so players can start
+        # before the whole file exists
+        command += ['-c', 'copy', '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+    return command + ['pipe:1']
+
+
+class FFmpegStream:
+    """Iterate over the stdout of an ffmpeg process in fixed-size chunks.
+
+    Chunks are only read when the consumer asks for the next one; when a slow
+    client stops reading, the pipe fills up and ffmpeg (and with it the
+    upstream download) pauses instead of buffering in memory.
+    """
+
+    def __init__(self, command, chunk_size=64 * 1024, on_close=None):
+        self.chunk_size = chunk_size
+        self.on_close = on_close
+        self.bytes_sent = 0
+        self._closed = False
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._first_chunk = None
+
+    def start(self):
+        """Wait for the first bytes so failures can still be reported as an HTTP error"""
+        self._first_chunk = self._process.stdout.read(self.chunk_size)
+        if not self._first_chunk:
+            returncode = self._process.wait()
+            self.close()
+            raise StreamError(f'ffmpeg exited with code {returncode} before producing output')
+        return self
+
+    def __iter__(self):
+        try:
+            if self._first_chunk:
+                chunk, self._first_chunk = self._first_chunk, None
+                self.bytes_sent += len(chunk)
+                yield chunk
+            while True:
+                chunk = self._process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.bytes_sent += len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop ffmpeg; called when the stream ends or the client goes away"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.stdout.close()
+        self._process.wait()
+        if self.on_close:
+            self.on_close()
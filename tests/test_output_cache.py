@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from output_cache import OutputCache
+from state_store import reset
+
+
+def make_cache(tmp_path):
+    return OutputCache(str(tmp_path / 'outputs'), str(tmp_path / 'outputs.sqlite3'))
+
+
+def test_claim_attaches_to_a_running_job(tmp_path):
+    cache = make_cache(tmp_path)
+
+    assert cache.claim('k', 'first') == 'first'
+    assert cache.claim('k', 'second') == 'first'
+
+
+def test_claim_of_a_previous_process_with_the_same_pid_is_taken_over(tmp_path):
+    cache = make_cache(tmp_path)
+    conn = cache.db.connect()
+    # Left by a process that had this pid before a restart
+    for pid in (os.getpid(), 1):
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO claims (key, job_id, pid, owner) VALUES (?, ?, ?, ?)',
+                         ('k', 'oldjob', pid, f'{pid}:1'))
+        assert cache.claim('k', 'newjob') == 'newjob'
+
+
+def test_reset_drops_claims(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.claim('k', 'first')
+
+    reset(str(tmp_path / 'outputs.sqlite3'))
+
+    assert cache.claim('k', 'second') == 'second'
@@ -0,0 +1,36 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postprocess import StreamingTranscode
+
+
+def test_streaming_transcode_started_before_the_file_exists(tmp_path):
+    source = tmp_path / 'audio.webm'
+    output = tmp_path / 'audio.out'
+    written = [0]
+    lock = threading.Lock()
+
+    def available():
+        with lock:
+            return written[0]
+
+    # cat stands in for ffmpeg reading pipe:0
+    transcode = StreamingTranscode(['sh', '-c', f'cat > {output}'], str(source), available,
+                                   chunk_size=1024, poll_interval=0.01)
+
+    # Let the feeder look for the file before the download creates it
+    time.sleep(0.05)
+    data = os.urandom(64 * 1024)
+    with open(source, 'wb') as f:
+        for offset in range(0, len(data), 4096):
+            f.write(data[offset:offset + 4096])
+            f.flush()
+            with lock:
+                written[0] = offset + 4096
+    transcode.finish()
+
+    assert output.read_bytes() == data
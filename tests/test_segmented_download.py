@@ -0,0 +1,65 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segmented_download import SegmentedDownload, SegmentError
+
+DATA = os.urandom(180000)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    status = 206
+
+    def do_GET(self):
+        if self.status != 206:
+            self.send_response(self.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = self.headers['Range'].split('=')[1].split('-')
+        body = DATA[int(start):int(end) + 1]
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    RangeHandler.status = 206
+
+
+def test_complete_download_is_renamed_to_path(server, tmp_path):
+    path = str(tmp_path / 'Clip.mp4')
+    download = SegmentedDownload(f'http://127.0.0.1:{server.server_port}/', len(DATA), path, segment_size=32768)
+
+    assert download.run() == path
+    assert open(path, 'rb').read() == DATA
+    assert not os.path.exists(download.part_path)
+
+
+def test_failed_download_never_appears_at_path(server, tmp_path):
+    RangeHandler.status = 403
+    path = str(tmp_path / 'Clip.mp4')
+    download = SegmentedDownload(f'http://127.0.0.1:{server.server_port}/', len(DATA), path, segment_size=32768)
+
+    with pytest.raises(SegmentError):
+        download.run()
+    assert not os.path.exists(path)
+
+    download.discard()
+    assert os.listdir(tmp_path) == []
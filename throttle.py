@@ -0,0 +1,87 @@
+"""Detection of stream URLs that the server has started to throttle"""
+import collections
+import threading
+import time
+
+
+class Throttled(Exception):
+    """Raised from a progress hook to abort a transfer whose stream URL is throttled"""
+
+
+class ThrottleDetector:
+    """Spot a sustained throughput collapse from the byte counts of one download.
+
+    The transfer counts as throttled when it moved less than min_speed bytes
+    per second over the last window seconds. Nothing is judged during the
+    first grace seconds after a start or resume, while connections warm up.
+    """
+
+    def __init__(self, min_speed, window=15.0, grace=10.0):
+        self.min_speed = min_speed
+        self.window = window
+        self.grace = grace
+        self._samples = collections.deque()
+        self._started = None
+
+    def reset(self):
+        """Start measuring afresh, e.g. after resuming with a new URL"""
+        self._samples.clear()
+        self._started = None
+
+    def sample(self, nbytes, limit=None, now=None):
+        """Record nbytes transferred; return the measured speed if throttled, else None.
+
+        limit is the rate the job is allowed to use; a transfer that is slow
+        because of our own bandwidth sharing is not reported.
+        """
+        if not self.min_speed:
+            return None
+        if now is None:
+            now = time.time()
+        if self._started is None:
+            self._started = now
+        self._samples.append((now, nbytes))
+        while now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+        if now - self._started < self.grace + self.window:
+            return None
+        speed = sum(n for _, n in self._samples) / self.window
+        threshold = min(self.min_speed, limit / 2) if limit else self.min_speed
+        return speed if speed < threshold else None
+
+
+class ThrottleMonitor:
+    """Create per-download detectors and count how often throttling happens"""
+
+    def __init__(self, min_speed=128 * 1024, window=15.0, grace=10.0, max_resumes=3):
+        self.min_speed = min_speed
+        self.window = window
+        self.grace = grace
+        self.max_resumes = max_resumes
+        self._lock = threading.Lock()
+        self.detected = 0
+        self.resumed = 0
+        self.gave_up = 0
+
+    def detector(self):
+        return ThrottleDetector(self.min_speed, self.window, self.grace)
+
+    def record(self, resumed):
+        """Count a detected throttle and whether the download was resumed"""
+        with self._lock:
+            self.detected += 1
+            if resumed:
+                self.resumed += 1
+            else:
+                self.gave_up += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_speed': self.min_speed,
+                'window': self.window,
+                'detected': self.detected,
+                'resumed': self.resumed,
+                'gave_up': self.gave_up,
+            }
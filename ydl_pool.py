@@ -0,0 +1,96 @@
+"""Reusable yt_dlp.YoutubeDL instances, kept per option profile"""
+import collections
+import contextlib
+import copy
+import json
+import threading
+
+import yt_dlp
+
+
+class YoutubeDLPool:
+    """Idle YoutubeDL instances, keyed by the options they were built with.
+
+    A checked-out instance serves one task at a time and then goes back to
+    the pool with its request handlers, and so the keep-alive connections in
+    them, and its extractor instances (with their in-memory player data)
+    intact. Only options without per-task values (hooks, output paths) make
+    useful profiles. An instance is closed after max_uses tasks, and the
+    least recently used profile once more than max_profiles are held.
+    """
+
+    def __init__(self, max_idle=4, max_profiles=16, max_uses=500):
+        self.max_idle = max_idle
+        self.max_profiles = max_profiles
+        self.max_uses = max_uses
+
+        # profile key -> list of (instance, uses), most recently used profile last
+        self._idle = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+
+    @staticmethod
+    def profile_key(ydl_opts):
+        return json.dumps(ydl_opts, sort_keys=True, default=repr)
+
+    @contextlib.contextmanager
+    def checkout(self, ydl_opts):
+        """Lend a YoutubeDL built with ydl_opts for the duration of a with block"""
+        key = self.profile_key(ydl_opts)
+        ydl, uses = self._take(key, ydl_opts)
+        try:
+            yield ydl
+        except yt_dlp.utils.DownloadError:
+            # An ordinary failed extraction; the instance itself is fine
+            self._put(key, ydl, uses + 1)
+            raise
+        except BaseException:
+            self._close(ydl)
+            raise
+        self._put(key, ydl, uses + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'profiles': len(self._idle),
+                'idle': sum(len(instances) for instances in self._idle.values()),
+                'created': self.created,
+                'reused': self.reused,
+                'closed': self.closed,
+            }
+
+    def _take(self, key, ydl_opts):
+        with self._lock:
+            instances = self._idle.get(key)
+            if instances:
+                self._idle.move_to_end(key)
+                self.reused += 1
+                return instances.pop()
+            self.created += 1
+        # Private copy: YoutubeDL keeps the dict and reads it live
+        return yt_dlp.YoutubeDL(copy.deepcopy(ydl_opts)), 0
+
+    def _put(self, key, ydl, uses):
+        evicted = []
+        with self._lock:
+            instances = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if uses < self.max_uses and len(instances) < self.max_idle:
+                instances.append((ydl, uses))
+            else:
+                evicted.append(ydl)
+            while len(self._idle) > self.max_profiles:
+                _, old = self._idle.popitem(last=False)
+                evicted.extend(instance for instance, _ in old)
+        for instance in evicted:
+            self._close(instance)
+
+    def _close(self, ydl):
+        try:
+            ydl.close()
+        except Exception as e:
+            print(f"Error closing YoutubeDL instance: {e}")
+        with self._lock:
+            self.closed += 1
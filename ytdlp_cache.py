@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""yt-dlp's on-disk cache (player JS and signature solutions) shared by all workers.
+
+The cache lives under a directory named after the installed yt-dlp
+version, so an upgrade starts from an empty cache and the directories of
+other versions are removed. Run this file before starting the server to
+solve the current YouTube player once per host:
+
+    python ytdlp_cache.py
+
+YTDLP_CACHE_DIR, YTDLP_WARM_VIDEO and YTDLP_WARM_MAX_AGE configure it;
+EXTRACT_PROFILE and EXTRACT_PLAYER_CLIENTS are read like the app does, so
+the warm-up uses the same player clients as /extract.
+"""
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+
+import yt_dlp
+
+from extraction_profiles import extract_opts, parse_player_clients
+
+DEFAULT_ROOT = os.path.join('cache', 'yt-dlp')
+# Short, public and long-lived: "Me at the zoo"
+DEFAULT_WARM_VIDEO = 'jNQXAC9IVRw'
+MARKER = '.warmed'
+
+
+def version_key():
+    """Identifies the yt-dlp build; cached solutions are only valid for the build that made them"""
+    key = yt_dlp.version.__version__
+    git_head = getattr(yt_dlp.version, 'RELEASE_GIT_HEAD', None)
+    if git_head:
+        key += '-' + git_head[:12]
+    return key
+
+
+def cache_dir(root=DEFAULT_ROOT):
+    """Cache directory for the installed yt-dlp under root"""
+    path = os.path.join(root, version_key())
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def prune(root=DEFAULT_ROOT):
+    """Remove the cache directories of other yt-dlp versions"""
+    current = version_key()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name != current and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def warm(root=DEFAULT_ROOT, video_id=DEFAULT_WARM_VIDEO, max_age=3600, ydl_opts=None):
+    """Extract one video so the current player is downloaded and solved into the cache.
+
+    Only one process on the host does the work; others wait for it and then
+    return. Nothing happens when the cache was warmed less than max_age
+    seconds ago. Returns True if this call extracted the video.
+    """
+    path = cache_dir(root)
+    prune(root)
+    marker = os.path.join(path, MARKER)
+
+    with open(os.path.join(path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(marker) and time.time() - os.path.getmtime(marker) < max_age:
+                return False
+
+            opts = {
+                'quiet': True,
+                'no_warnings': True,
+                'skip_download': True,
+                **(ydl_opts or {}),
+                'cachedir': path,
+            }
+            started = time.time()
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                ydl.extract_info(f'https://www.youtube.com/watch?v={video_id}', download=False)
+
+            with open(marker, 'w') as f:
+                json.dump({'version': version_key(), 'video_id': video_id, 'seconds': time.time() - started}, f)
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main():
+    root = os.environ.get('YTDLP_CACHE_DIR', DEFAULT_ROOT)
+    ydl_opts = extract_opts(os.environ.get('EXTRACT_PROFILE', 'lite'),
+                            parse_player_clients(os.environ.get('EXTRACT_PLAYER_CLIENTS')))
+    started = time.time()
+    try:
+        warmed = warm(root,
+                      os.environ.get('YTDLP_WARM_VIDEO', DEFAULT_WARM_VIDEO),
+                      float(os.environ.get('YTDLP_WARM_MAX_AGE', '3600')),
+                      ydl_opts)
+    except Exception as e:
+        # A cold cache only costs the first requests time; never block the start
+        print(f"Warming the yt-dlp cache failed: {e}")
+        sys.exit(1)
+    state = 'warmed' if warmed else 'already warm'
+    print(f"yt-dlp cache {cache_dir(root)} {state} ({time.time() - started:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()